@@ -1,13 +1,27 @@
 import streamlit as st
 import pandas as pd
-from supabase import create_client, Client
-from datetime import datetime
+from supabase import create_client, Client, ClientOptions
+from postgrest.exceptions import APIError
+from datetime import datetime, timedelta
 import pytz
 import time
+import threading
+import json
+import csv
+import io
+import hashlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 import plotly.express as px
 from fpdf import FPDF
-import qrcode
 from io import BytesIO
+from openpyxl import Workbook, load_workbook
+from credenciales import FPDFMemoria, generar_qr_png, generar_pdf_alumno_final, lote_credenciales, qrs_en_paralelo
+from servicio_escaneo import (TAM_PAGINA, TAM_LOTE_ENVIO, REINTENTOS_ENVIO, TTL_PADRON, COLUMNAS_PADRON,
+                              PREFIJO_FOTO_PENDIENTE, AvisosActivos, ColaEntradas, ColaEvidencias,
+                              EntradasDelDia, Latencias, PadronAlumnos, ServicioEscaneo,
+                              comprimir_evidencia, configurar_log_latencias, normalizar_matricula,
+                              enviar_lote as _enviar_lote, leer_paginado as _leer_paginado)
 # 1. CONFIGURACIÓN INICIAL (DEBE SER LO PRIMERO)
 st.set_page_config(page_title="SICA CONALEP CUAUTLA", layout="wide")
 zona = pytz.timezone("America/Mexico_City")
@@ -25,35 +39,11 @@ st.markdown("""
     pointer-events: none;
 }
 
-@keyframes flashGreen {
-    0% { background-color: rgba(0, 230, 118, 0.0); }
-    40% { background-color: rgba(0, 230, 118, 0.35); }
-    100% { background-color: rgba(0, 230, 118, 0.0); }
-}
-
-@keyframes flashAmber {
-    0% { background-color: rgba(255, 152, 0, 0.0); }
-    40% { background-color: rgba(255, 152, 0, 0.35); }
-    100% { background-color: rgba(255, 152, 0, 0.0); }
-}
-
-@keyframes flashRed {
-    0% { background-color: rgba(255, 23, 68, 0.0); }
-    40% { background-color: rgba(255, 23, 68, 0.35); }
-    100% { background-color: rgba(255, 23, 68, 0.0); }
-}
-
-.flash-ok {
-    animation: flashGreen 0.6s ease-in-out;
-}
-
-.flash-warn {
-    animation: flashAmber 0.6s ease-in-out;
-}
-
-.flash-error {
-    animation: flashRed 0.6s ease-in-out;
-}
+/* El color va en la clase; el destello y el ocultado del resultado los anima
+   estilo_resultado() con nombres propios de cada lectura */
+.flash-ok { background-color: rgba(0, 230, 118, 0.35); opacity: 0; }
+.flash-warn { background-color: rgba(255, 152, 0, 0.35); opacity: 0; }
+.flash-error { background-color: rgba(255, 23, 68, 0.35); opacity: 0; }
 </style>
 """, unsafe_allow_html=True)
 
@@ -69,13 +59,478 @@ def init_connection():
 
 supabase = init_connection()
 
-def normalizar_matricula(mat):
-    if not mat: return ""
-    return mat.strip().upper().replace('"', '-').replace("'", '-')
+TIMEOUT_KIOSKO = 2  # segundos; pasado esto la entrada se guarda en la cola local
+
+@st.cache_resource
+def init_conexion_kiosko():
+    # Cliente propio de la Puerta de Entrada con tiempo límite corto
+    return create_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_KEY"],
+                         options=ClientOptions(postgrest_client_timeout=TIMEOUT_KIOSKO))
 
 def enviar(tabla, datos):
     datos_db = {k.lower(): v for k, v in datos.items()}
-    return supabase.table(tabla).insert(datos_db).execute()
+    with latencias().medir(f"enviar:{tabla}"):
+        res = supabase.table(tabla).insert(datos_db).execute()
+    invalidar_consultas(tabla)
+    return res
+
+def estilo_resultado(n):
+    # Cada lectura trae animaciones con nombre nuevo: aunque el navegador reuse
+    # el mismo nodo del resultado anterior, cambiar el nombre las reinicia
+    return f"""
+    <style>
+    @keyframes destello{n} {{ 0% {{ opacity: 0; }} 40% {{ opacity: 1; }} 100% {{ opacity: 0; }} }}
+    @keyframes ocultarResultado{n} {{
+        to {{ opacity: 0; visibility: hidden; height: 0; margin: 0; padding: 0; overflow: hidden; }}
+    }}
+    .flash-{n} {{ animation: destello{n} 0.6s ease-in-out; }}
+    .resultado-{n} {{ animation: ocultarResultado{n} 0.4s ease-in 3.5s forwards; }}
+    </style>
+    """
+
+# ================= ENVÍO POR LOTES =================
+def enviar_lote(tabla, registros, tam_lote=TAM_LOTE_ENVIO, reintentos=REINTENTOS_ENVIO, on_conflict=None,
+                fusionar=False):
+    # Ver servicio_escaneo.enviar_lote; aquí con el cliente principal y la caché
+    enviados, fallidos = _enviar_lote(supabase, tabla, registros, tam_lote, reintentos, on_conflict, fusionar)
+    if enviados:
+        invalidar_consultas(tabla)
+    return enviados, fallidos
+
+# ================= LECTURA PAGINADA =================
+def leer_paginado(tabla, columnas, filtros=(), clave="id", tam_pagina=TAM_PAGINA):
+    # Ver servicio_escaneo.leer_paginado
+    return _leer_paginado(supabase, tabla, columnas, filtros, clave, tam_pagina)
+
+# ================= CACHÉ DE CONSULTAS =================
+# Streamlit vuelve a ejecutar todo el script con cada clic; los paneles de solo
+# lectura guardan aquí sus resultados por TTL_CONSULTAS segundos. Cada entrada
+# declara de qué tablas depende y cualquier escritura en ellas la descarta.
+TTL_CONSULTAS = 60
+MAX_CONSULTAS = 256
+
+class CacheConsultas:
+    def __init__(self, ttl=TTL_CONSULTAS, maximo=MAX_CONSULTAS):
+        self.ttl = ttl
+        self.maximo = maximo
+        self.metricas = {"aciertos": 0, "fallos": 0, "invalidaciones": 0}
+        self._lock = threading.Lock()
+        self._datos = OrderedDict()  # clave -> (tablas, instante, valor)
+
+    def obtener(self, tablas, clave, calcular):
+        with self._lock:
+            registro = self._datos.get(clave)
+            if registro and time.monotonic() - registro[1] <= self.ttl:
+                self._datos.move_to_end(clave)
+                self.metricas["aciertos"] += 1
+                return registro[2]
+            self.metricas["fallos"] += 1
+        valor = calcular()
+        with self._lock:
+            self._datos[clave] = (frozenset(tablas), time.monotonic(), valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.maximo:
+                self._datos.popitem(last=False)
+        return valor
+
+    def invalidar(self, tabla):
+        with self._lock:
+            for clave in [c for c, (tablas, _, _) in self._datos.items() if tabla in tablas]:
+                del self._datos[clave]
+                self.metricas["invalidaciones"] += 1
+
+@st.cache_resource
+def cache_consultas():
+    return CacheConsultas()
+
+def en_cache(tablas, clave, calcular):
+    return cache_consultas().obtener(tablas, clave, calcular)
+
+def invalidar_consultas(*tablas):
+    for tabla in tablas:
+        cache_consultas().invalidar(tabla)
+
+def _congelar(valor):
+    # Las listas (p. ej. el valor de un filtro in_) no sirven como clave de caché
+    return tuple(_congelar(v) for v in valor) if isinstance(valor, (list, tuple)) else valor
+
+def leer_tabla(tabla, columnas, filtros=(), clave="id"):
+    # leer_paginado completo, servido desde la caché mientras no haya escrituras
+    filtros = _congelar(filtros)
+    clave = _congelar(clave)
+    return en_cache((tabla,), ("tabla", tabla, columnas if isinstance(columnas, str) else tuple(columnas), filtros, clave),
+                    lambda: [f for pagina in leer_paginado(tabla, columnas, filtros, clave) for f in pagina])
+
+# ================= HISTORIAL POR VENTANAS =================
+# Historial y Expediente muestran primero los registros más recientes de la
+# matrícula; "Cargar más" trae la siguiente ventana con un rango sobre (fecha, id).
+# Las ventanas ya vistas se guardan en la sesión y se descartan si aparecen
+# registros nuevos al principio.
+TAM_VENTANA_HISTORIAL = 20
+
+def leer_recientes(tabla, columnas, mat, tam, antes=None, cliente=None):
+    # (filas, hay_mas); 'antes' es (fecha, id) de la última fila ya mostrada
+    consulta = (cliente or supabase).table(tabla).select(columnas).eq("matricula", mat)
+    if antes:
+        fecha, id_ = antes
+        consulta = consulta.or_(f"fecha.lt.{fecha},and(fecha.eq.{fecha},id.lt.{id_})")
+    filas = consulta.order("fecha", desc=True).order("id", desc=True).limit(tam + 1).execute().data or []
+    return filas[:tam], len(filas) > tam
+
+def primera_ventana(tabla, columnas, mat, tam=TAM_VENTANA_HISTORIAL, cache=None, cliente=None):
+    # Con 'cache' se puede llamar desde otro hilo (consultar_en_paralelo)
+    return (cache or cache_consultas()).obtener((tabla,), ("recientes", tabla, columnas, mat, tam),
+                                                 lambda: leer_recientes(tabla, columnas, mat, tam, cliente=cliente))
+
+def ventana_historial(tabla, columnas, mat, tam=TAM_VENTANA_HISTORIAL, primera=None):
+    # {"filas": [...], "hay_mas": bool} con lo cargado hasta ahora en esta sesión.
+    # 'columnas' debe incluir fecha e id; 'primera' si ya se leyó con primera_ventana.
+    primera, hay_mas = primera or primera_ventana(tabla, columnas, mat, tam)
+    ventanas = st.session_state.setdefault("ventanas_historial", {})
+    for llave in [k for k in ventanas if k[2] != mat]:
+        del ventanas[llave]
+    llave = (tabla, columnas, mat)
+    ventana = ventanas.get(llave)
+    if ventana is None or ventana["primera"] != primera:
+        ventana = ventanas[llave] = {"primera": primera, "filas": list(primera), "hay_mas": hay_mas}
+    return ventana
+
+def cargar_mas_historial(tabla, columnas, mat, tam=TAM_VENTANA_HISTORIAL):
+    ventana = st.session_state["ventanas_historial"][(tabla, columnas, mat)]
+    ultima = ventana["filas"][-1]
+    filas, ventana["hay_mas"] = leer_recientes(tabla, columnas, mat, tam, (ultima["fecha"], ultima["id"]))
+    ventana["filas"].extend(filas)
+
+def boton_cargar_mas(ventana, tabla, columnas, mat, clave):
+    if ventana["hay_mas"]:
+        st.button(f"⬇️ Cargar {TAM_VENTANA_HISTORIAL} más", key=clave, on_click=cargar_mas_historial,
+                  args=(tabla, columnas, mat), use_container_width=True)
+    st.caption(f"Mostrando {len(ventana['filas'])} registros" + (" (hay más anteriores)" if ventana["hay_mas"] else ""))
+
+# ================= CONSULTAS EN PARALELO =================
+# Para pantallas que piden varias tablas independientes a la vez: cada consulta
+# va a un hilo del pool y todas comparten un mismo límite de tiempo, así la
+# pantalla tarda lo que la consulta más lenta y no la suma de todas.
+# futuro.cancel() no detiene una consulta que ya corre, así que todas usan un
+# cliente cuyo tiempo límite no pasa de TIEMPO_MAXIMO_EXPEDIENTE: una consulta
+# colgada libera su hilo a tiempo y no deja al pool sin hilos.
+TIEMPO_MAXIMO_EXPEDIENTE = 8  # segundos
+
+@st.cache_resource
+def init_conexion_expediente():
+    return create_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_KEY"],
+                         options=ClientOptions(postgrest_client_timeout=TIEMPO_MAXIMO_EXPEDIENTE))
+
+@st.cache_resource
+def pool_consultas():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="consultas")
+
+def consultar_en_paralelo(consultas, limite):
+    # consultas = {nombre: función que recibe el cliente}; devuelve ({nombre: resultado}, {nombre: error}).
+    # Las funciones corren fuera del hilo de Streamlit: no deben tocar st.*
+    pool = pool_consultas()
+    cliente = init_conexion_expediente()
+    futuros = {nombre: pool.submit(consulta, cliente) for nombre, consulta in consultas.items()}
+    fin = time.monotonic() + limite
+    resultados, errores = {}, {}
+    for nombre, futuro in futuros.items():
+        try:
+            resultados[nombre] = futuro.result(timeout=max(fin - time.monotonic(), 0))
+        except FuturesTimeout:
+            futuro.cancel()
+            errores[nombre] = f"sin respuesta en {limite} s"
+        except Exception as e:
+            errores[nombre] = str(e)
+    return resultados, errores
+
+# ================= INCIDENCIAS POR ALUMNO =================
+# Total de reportes, último nivel y última fecha de un alumno en una sola fila
+# (sql/009_incidencias_alumno.sql, mantenida por trigger al guardar reportes).
+NIVELES_REPORTE = ["LLAMADA 1", "LLAMADA 2", "LLAMADA 3"]
+
+def incidencias_alumno(mat, cliente=None):
+    cliente = cliente or supabase
+    try:
+        res = cliente.table("incidencias_alumno").select("total, ultimo_nivel, ultima_fecha") \
+            .eq("matricula", mat).limit(1).execute()
+        if res.data:
+            return res.data[0]
+        return {"total": 0, "ultimo_nivel": None, "ultima_fecha": None}
+    except APIError:
+        # Base sin sql/009: se cuenta como antes
+        res = cliente.table("reportes").select("id", count="exact").eq("matricula", mat).execute()
+        return {"total": res.count or 0, "ultimo_nivel": None, "ultima_fecha": None}
+
+def nivel_sugerido(total):
+    # Lógica 3+1: tres llamadas y después reporte
+    return NIVELES_REPORTE[total] if total < len(NIVELES_REPORTE) else "REPORTE"
+
+def riesgo_alumno(total):
+    # (color, texto) para el Expediente Digital
+    if total == 0: return "#00e676", "BAJO"
+    if total <= 2: return "#ffeb3b", "MEDIO"
+    return "#ff5252", "ALTO"
+
+# ================= CACHÉ DE PDF =================
+# Los PDF se generan solo cuando alguien presiona "Descargar" y se guardan por
+# la huella de sus datos de entrada; el mismo expediente, mes o credencial
+# devuelve los mismos bytes sin pasar otra vez por FPDF.
+MAX_BYTES_PDF = 64 * 1024 * 1024
+
+class CachePDF:
+    def __init__(self, maximo_bytes=MAX_BYTES_PDF):
+        self.maximo_bytes = maximo_bytes
+        self.bytes = 0
+        self.metricas = {"aciertos": 0, "fallos": 0}
+        self._lock = threading.Lock()
+        self._datos = OrderedDict()  # huella -> bytes del PDF
+
+    def obtener(self, huella, generar):
+        with self._lock:
+            pdf = self._datos.get(huella)
+            if pdf is not None:
+                self._datos.move_to_end(huella)
+                self.metricas["aciertos"] += 1
+                return pdf
+            self.metricas["fallos"] += 1
+        pdf = generar()
+        with self._lock:
+            if huella not in self._datos and len(pdf) <= self.maximo_bytes:
+                self._datos[huella] = pdf
+                self.bytes += len(pdf)
+                while self.bytes > self.maximo_bytes:
+                    _, viejo = self._datos.popitem(last=False)
+                    self.bytes -= len(viejo)
+        return pdf
+
+@st.cache_resource
+def cache_pdf():
+    return CachePDF()
+
+def pdf_diferido(tipo, entradas, generar):
+    # Para st.download_button(data=...): Streamlit ejecuta la función al hacer
+    # clic, en otro hilo, así que la caché se resuelve aquí en el script.
+    cache = cache_pdf()
+    huella = hashlib.sha256(json.dumps([tipo, entradas], sort_keys=True, default=str).encode()).hexdigest()
+    return lambda: cache.obtener(huella, generar)
+
+# ================= TABLAS EN PDF =================
+def _latin1(serie):
+    # Limpieza de toda la columna de una vez (FPDF solo acepta latin-1)
+    return serie.fillna("").astype(str).str.encode('latin-1', 'replace').str.decode('latin-1')
+
+class TablaPDF:
+    # Tabla con encabezado repetido en cada página y renglones que se ajustan.
+    # columnas: [(titulo, campo, ancho, ajustar)]; con ajustar=True el texto
+    # largo se parte en varias líneas en lugar de salirse de la celda.
+    def __init__(self, pdf, columnas, alto_linea=8, alto_renglon=5, margen_inferior=15):
+        self.pdf = pdf
+        self.columnas = columnas
+        self.alto_linea = alto_linea      # fila de un solo renglón
+        self.alto_renglon = alto_renglon  # cada renglón de un texto partido
+        self.limite = pdf.h - margen_inferior
+        self.filas = 0
+        self._lineas = {}  # (texto, ancho) -> renglones; los nombres se repiten mucho
+        pdf.set_auto_page_break(auto=False)
+        self.encabezado()
+
+    def encabezado(self):
+        pdf = self.pdf
+        pdf.set_fill_color(30, 132, 73)
+        pdf.set_text_color(255, 255, 255)
+        pdf.set_font("Arial", 'B', 10)
+        for titulo, _, ancho, _ in self.columnas:
+            pdf.cell(ancho, 10, titulo, 1, 0, 'C', True)
+        pdf.ln()
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font("Arial", '', 9)
+
+    def _partir(self, texto, ancho):
+        clave = (texto, ancho)
+        if clave not in self._lineas:
+            if self.pdf.get_string_width(texto) <= ancho - 2 * self.pdf.c_margin:
+                self._lineas[clave] = [texto]
+            else:
+                self._lineas[clave] = self.pdf.multi_cell(ancho, self.alto_renglon, texto, split_only=True) or [""]
+        return self._lineas[clave]
+
+    def agregar(self, datos_df):
+        pdf = self.pdf
+        limpias = [_latin1(datos_df[campo]) for _, campo, _, _ in self.columnas]
+        for valores in zip(*limpias):
+            lineas = [self._partir(v, ancho) if ajustar else [v]
+                      for v, (_, _, ancho, ajustar) in zip(valores, self.columnas)]
+            alto = max(self.alto_linea, max(len(l) for l in lineas) * self.alto_renglon)
+            if pdf.get_y() + alto > self.limite:
+                pdf.add_page()
+                self.encabezado()
+            x, y = pdf.l_margin, pdf.get_y()
+            for renglones, (_, _, ancho, _) in zip(lineas, self.columnas):
+                if len(renglones) == 1:
+                    pdf.set_xy(x, y)
+                    pdf.cell(ancho, alto, renglones[0], 1)
+                else:
+                    pdf.rect(x, y, ancho, alto)
+                    y_texto = y + (alto - len(renglones) * self.alto_renglon) / 2
+                    for i, renglon in enumerate(renglones):
+                        pdf.set_xy(x, y_texto + i * self.alto_renglon)
+                        pdf.cell(ancho, self.alto_renglon, renglon)
+                x += ancho
+            pdf.set_xy(pdf.l_margin, y + alto)
+        self.filas += len(datos_df)
+
+TALLERES = ["Informática", "Autotronica", "SHYPC", "Contabilidad"]
+
+COLUMNAS_BITACORA_GENERAL = [
+    ("FECHA", "fecha", 22, False),
+    ("DOCENTE", "maestro", 35, True),
+    ("TALLER", "taller", 28, True),
+    ("GRUPO", "grupo", 22, False),
+    ("PRÁCTICA", "nombre_practica", 65, True),
+    ("ASIST.", "alumnos_asistentes", 18, False),
+]
+
+COLUMNAS_BITACORA = [
+    ("FECHA", "fecha", 30, False),
+    ("GRUPO", "grupo", 30, False),
+    ("PRÁCTICA", "nombre_practica", 90, True),
+    ("ASIST.", "alumnos_asistentes", 40, False),
+]
+
+# ================= CACHÉS DE LA PUERTA DE ENTRADA =================
+# Las clases viven en servicio_escaneo.py (con el cliente inyectado); aquí solo
+# se crea una instancia compartida por servidor. Leen con el cliente del kiosko:
+# mientras la carga inicial no funcione se reintenta en cada lectura, y así
+# cada intento tarda a lo más TIMEOUT_KIOSKO por consulta.
+@st.cache_resource
+def padron_alumnos():
+    # Compartido por todas las sesiones del servidor (kioskos y Expediente Digital)
+    return PadronAlumnos(init_conexion_kiosko())
+
+@st.cache_resource
+def avisos_activos():
+    return AvisosActivos(init_conexion_kiosko())
+
+@st.cache_resource
+def entradas_del_dia():
+    return EntradasDelDia(init_conexion_kiosko(), zona)
+
+@st.cache_resource
+def cola_entradas():
+    return ColaEntradas(supabase, cache=cache_consultas())
+
+# ================= EVIDENCIAS DE REPORTES (SUBIDA EN SEGUNDO PLANO) =================
+# ColaEvidencias vive en servicio_escaneo.py junto a la cola de entradas.
+@st.cache_resource
+def cola_evidencias():
+    return ColaEvidencias(supabase, cache=cache_consultas())
+
+@st.cache_resource
+def latencias():
+    # Histogramas por etapa de las lecturas y de enviar(), para el panel de ADMIN;
+    # las trazas van además al logger 'sica.latencias' (ver SICA_LOG_LATENCIAS)
+    configurar_log_latencias()
+    return Latencias()
+
+@st.cache_resource
+def servicio_escaneo():
+    # Una instancia por servidor: todas las puertas comparten cachés y conexión
+    return ServicioEscaneo(init_conexion_kiosko(), padron_alumnos(), entradas_del_dia(),
+                           avisos_activos(), cola_entradas(), zona, latencias())
+
+# ================= IMPORTACIÓN DEL PADRÓN (XLSX / CSV) =================
+# El archivo de inscripción se lee fila por fila y se compara contra 'alumnos';
+# a la base solo viajan los alumnos nuevos o los que cambiaron.
+ENCABEZADOS_PADRON = {
+    "MATRICULA": "matricula", "MATRÍCULA": "matricula",
+    "NOMBRE": "nombre", "NOMBRE COMPLETO": "nombre", "ALUMNO": "nombre",
+    "GRUPO": "grupo",
+    "ESTATUS": "estatus", "STATUS": "estatus", "ACTIVO": "estatus",
+}
+ESTATUS_ACTIVO = {"1", "TRUE", "VERDADERO", "SI", "SÍ", "ACTIVO", "A"}
+ESTATUS_BLOQUEADO = {"0", "FALSE", "FALSO", "NO", "BAJA", "BLOQUEADO", "INACTIVO", "B"}
+
+def _filas_archivo(archivo, nombre):
+    if nombre.lower().endswith(".csv"):
+        texto = io.TextIOWrapper(archivo, encoding="utf-8-sig", errors="replace", newline="")
+        muestra = texto.read(4096)
+        texto.seek(0)
+        try:
+            dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t")
+        except csv.Error:
+            dialecto = csv.excel
+        try:
+            yield from csv.reader(texto, dialecto)
+        finally:
+            texto.detach()  # sin cerrar el archivo subido
+    else:
+        libro = load_workbook(archivo, read_only=True, data_only=True)
+        try:
+            yield from libro.active.iter_rows(values_only=True)
+        finally:
+            libro.close()
+
+def _texto_celda(valor):
+    # Excel entrega las matrículas numéricas como 1234.0
+    if isinstance(valor, float) and valor.is_integer(): valor = int(valor)
+    return str(valor if valor is not None else "").strip()
+
+def _estatus_archivo(valor):
+    if isinstance(valor, bool): return valor
+    texto = str(valor if valor is not None else "").strip().upper()
+    if texto in ESTATUS_ACTIVO: return True
+    if texto in ESTATUS_BLOQUEADO: return False
+    return None  # vacío o desconocido: se respeta el de la base
+
+def leer_archivo_padron(archivo, nombre):
+    # Devuelve ({matricula: fila}, trae_estatus, descartadas). Si una matrícula
+    # se repite en el archivo gana la última aparición.
+    filas = _filas_archivo(archivo, nombre)
+    columnas = None
+    for encabezado in filas:
+        columnas = [ENCABEZADOS_PADRON.get(str(c or "").strip().upper()) for c in encabezado]
+        if any(columnas): break
+    if not columnas or "matricula" not in columnas:
+        raise ValueError("El archivo no tiene una columna MATRICULA.")
+
+    alumnos, descartadas = {}, 0
+    for valores in filas:
+        fila = {}
+        for campo, valor in zip(columnas, valores):
+            if campo: fila[campo] = valor
+        mat = normalizar_matricula(_texto_celda(fila.get("matricula")))
+        if not mat:
+            if any(v not in (None, "") for v in valores): descartadas += 1
+            continue
+        alumno = {"matricula": mat}
+        for campo in ("nombre", "grupo"):
+            if campo in columnas:
+                alumno[campo] = _texto_celda(fila.get(campo)) or None
+        if "estatus" in columnas:
+            alumno["estatus"] = _estatus_archivo(fila.get("estatus"))
+        alumnos[mat] = alumno
+    return alumnos, "estatus" in columnas, descartadas
+
+def diferencias_padron(archivo_alumnos, actuales):
+    # Compara el archivo contra la base (ambos {matricula: fila}) y separa
+    # nuevos, datos cambiados y cambios de estatus. Los campos vacíos en el
+    # archivo no borran lo que ya hay en la base.
+    nuevos, actualizados, cambios_estatus = [], [], []
+    for mat, fila in archivo_alumnos.items():
+        actual = actuales.get(mat)
+        if actual is None:
+            nuevo = dict(fila)
+            if nuevo.get("estatus") is None: nuevo["estatus"] = True
+            nuevos.append(nuevo)
+            continue
+        cambio = {c: v for c, v in fila.items()
+                  if c != "matricula" and v is not None and v != actual.get(c)}
+        if not cambio: continue
+        if "estatus" in cambio: cambios_estatus.append(mat)
+        # Filas completas para que todas las del lote lleven las mismas columnas
+        combinado = {**actual, **{c: v for c, v in fila.items() if v is not None}}
+        actualizados.append({c: combinado.get(c) for c in ("matricula", "nombre", "grupo", "estatus")})
+    return nuevos, actualizados, cambios_estatus
 # ================
 # 2. INICIALIZAR SESSION STATE (EVITA EL ATTRIBUTE ERROR)
 if "user" not in st.session_state:
@@ -232,75 +687,30 @@ if menu == "Puerta de Entrada":
     if "procesando" not in st.session_state:
         st.session_state.procesando = False
 
+    if "n_resultado" not in st.session_state:
+        st.session_state.n_resultado = 0
+
+    padron = padron_alumnos()
+    entradas_hoy = entradas_del_dia()
+    avisos = avisos_activos()
+    cola = cola_entradas()
+    servicio = servicio_escaneo()
+    try:
+        padron.asegurar_carga()
+        entradas_hoy.asegurar_carga()
+        avisos.asegurar_carga()
+    except Exception as e:
+        st.warning(f"Datos en memoria no disponibles, se consultará en línea: {e}")
+
     def ejecutar_procesamiento(mat_raw):
         if not mat_raw or st.session_state.procesando:
             return
 
         st.session_state.procesando = True
-        mat = normalizar_matricula(mat_raw)
-
         try:
-            al_query = supabase.table("alumnos") \
-                .select("*, estatus") \
-                .filter("matricula", "eq", mat) \
-                .execute()
-
-            av_query = supabase.table("avisos") \
-                .select("mensaje, prioridad") \
-                .filter("matricula", "eq", mat) \
-                .filter("activo", "eq", True) \
-                .execute()
-
-            if not al_query.data:
-                st.session_state.resultado = {
-                    "tipo": "error",
-                    "mensaje": "MATRÍCULA NO REGISTRADA"
-                }
-
-            else:
-                al = al_query.data[0]
-
-                if al.get("estatus") is False:
-                    st.session_state.resultado = {
-                        "tipo": "bloqueado",
-                        "nombre": al.get("nombre"),
-                        "mensaje": "ACCESO DENEGADO / BLOQUEADO"
-                    }
-
-                else:
-                    # ================= EVITAR DOBLE ENTRADA EL MISMO DÍA =================
-                    fecha_hoy = datetime.now(zona).strftime("%Y-%m-%d")
-
-                    entrada_existente = supabase.table("entradas") \
-                        .select("id") \
-                        .eq("matricula", mat) \
-                        .eq("fecha", fecha_hoy) \
-                        .execute()
-
-                    if entrada_existente.data:
-                        st.session_state.resultado = {
-                            "tipo": "warning",
-                            "nombre": al.get("nombre"),
-                            "mensaje": "ENTRADA YA REGISTRADA HOY"
-                        }
-                        return
-                    # =====================================================================
-
-                    enviar("entradas", {
-                        "fecha": fecha_hoy,
-                        "hora": datetime.now(zona).strftime("%H:%M:%S"),
-                        "matricula": mat,
-                        "nombre": al.get("nombre", "N/A"),
-                        "grupo": al.get("grupo", "N/A"),
-                        "registro_por": user.get("usuario", "Sistema")
-                    })
-
-                    st.session_state.resultado = {
-                        "tipo": "ok",
-                        "nombre": al.get("nombre"),
-                        "grupo": al.get("grupo"),
-                        "aviso": av_query.data[0] if av_query.data else None
-                    }
+            st.session_state.resultado = servicio.escanear(mat_raw, user.get("usuario", "Sistema"))
+            # Cada lectura se pinta en un contenedor nuevo (ver estilo_resultado)
+            st.session_state.n_resultado += 1
 
         except Exception as e:
             st.error(f"Error: {e}")
@@ -321,14 +731,63 @@ if menu == "Puerta de Entrada":
             )
         )
 
-    # --- RESULTADOS VISUALES (DISEÑO ORIGINAL) ---
+    if rol == "ADMIN":
+        with st.expander("📈 Métricas del padrón en memoria"):
+            est = padron.estadisticas()
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Alumnos en memoria", est["alumnos"])
+            m2.metric("Aciertos", est["aciertos"], delta=f"{est['tasa_aciertos']}%", delta_color="off")
+            m3.metric("Fallos", est["fallos"], delta=f"{est['caducados']} caducados", delta_color="off")
+            m4.metric("Refrescos", est["refrescos"], delta=f"{est['errores_refresco']} errores", delta_color="off")
+            st.caption(f"Entradas de hoy en memoria: {len(entradas_hoy)} · "
+                       f"En cola local: {cola.pendientes()} (enviadas {cola.metricas['enviadas']})")
+            lecturas = dict(servicio.metricas)
+            st.caption(f"Lecturas en este servidor: {lecturas.pop('lecturas', 0)} "
+                       + " · ".join(f"{tipo}: {n}" for tipo, n in sorted(lecturas.items())))
+            est_av = avisos.estadisticas()
+            st.caption(f"Alumnos con aviso activo: {est_av['alumnos']} · "
+                       f"Refrescos de avisos: {est_av['refrescos']} ({est_av['errores_refresco']} errores)"
+                       + ("" if est_av["incremental"] else " · sin 'updated_at', se relee la lista completa"))
+            if servicio.sin_red():
+                st.caption(f"🔌 Sin red: las lecturas van directo a la cola local "
+                           f"({servicio.cortes_red} cortes desde que arrancó el servidor)")
+            if cola.ultimo_error and cola.pendientes():
+                st.caption(f"Último error de la cola: {cola.ultimo_error}")
+            if cola.rechazadas():
+                st.caption(f"⚠️ {cola.rechazadas()} entradas rechazadas por la base quedaron apartadas "
+                           f"en la tabla 'rechazadas' de {cola.ruta} para revisarlas a mano.")
+            if not est["incremental"]:
+                st.caption("Sin columna 'updated_at': los alumnos caducan cada "
+                           f"{TTL_PADRON} s y se vuelven a leer de la base.")
+
+        with st.expander("⏱️ Latencias por etapa (ms)"):
+            resumen_lat = servicio.latencias.resumen()
+            if resumen_lat:
+                st.dataframe(pd.DataFrame(resumen_lat), use_container_width=True, hide_index=True)
+                st.caption("rpc = registrar_escaneo (alumno, aviso e inserción en un viaje) · "
+                           "render = armado del resultado en pantalla · total = lectura completa sin render")
+                l1, l2 = st.columns(2)
+                l1.download_button("📥 Exportar trazas (JSONL)", servicio.latencias.exportar,
+                                   f"latencias_{datetime.now(zona).strftime('%Y%m%d_%H%M')}.jsonl",
+                                   "application/x-ndjson")
+                if l2.button("🔄 Reiniciar mediciones"):
+                    servicio.latencias.reiniciar()
+                    st.rerun()
+            else:
+                st.info("Aún no hay lecturas medidas en este servidor.")
+
+    # --- RESULTADOS VISUALES (DISEÑO ORIGINAL, SE OCULTAN EN EL NAVEGADOR) ---
     if st.session_state.resultado:
+        t_render = time.perf_counter()
         res = st.session_state.resultado
+        n = st.session_state.n_resultado
+        caja_resultado = st.container(key=f"resultado_{n}")
+        caja_resultado.markdown(estilo_resultado(n), unsafe_allow_html=True)
 
         if res["tipo"] == "ok":
-            st.markdown("<div class='flash-overlay flash-ok'></div>", unsafe_allow_html=True)
-            st.markdown(f"""
-                <div style='text-align:center;
+            caja_resultado.markdown(f"<div class='flash-overlay flash-ok flash-{n}'></div>", unsafe_allow_html=True)
+            caja_resultado.markdown(f"""
+                <div class='resultado-temporal resultado-{n}' style='text-align:center;
                             background:rgba(30, 132, 73, 0.2);
                             padding:40px;
                             border-radius:20px;
@@ -355,8 +814,8 @@ if menu == "Puerta de Entrada":
                 av = res["aviso"]
                 color_aviso = "#ff1744" if av["prioridad"] == "ALTA" else "#ffeb3b"
 
-                st.markdown(f"""
-                    <div style='margin-top:20px;
+                caja_resultado.markdown(f"""
+                    <div class='resultado-temporal resultado-{n}' style='margin-top:20px;
                                 padding:20px;
                                 background:rgba(255,255,255,0.1);
                                 border-left:10px solid {color_aviso};
@@ -374,9 +833,9 @@ if menu == "Puerta de Entrada":
                 """, unsafe_allow_html=True)
 
         elif res["tipo"] == "bloqueado":
-            st.markdown("<div class='flash-overlay flash-warn'></div>", unsafe_allow_html=True)
-            st.markdown(f"""
-                <div style='text-align:center;
+            caja_resultado.markdown(f"<div class='flash-overlay flash-warn flash-{n}'></div>", unsafe_allow_html=True)
+            caja_resultado.markdown(f"""
+                <div class='resultado-temporal resultado-{n}' style='text-align:center;
                             background:rgba(255, 152, 0, 0.2);
                             padding:40px;
                             border-radius:20px;
@@ -400,9 +859,9 @@ if menu == "Puerta de Entrada":
             """, unsafe_allow_html=True)
 
         else:  # ERROR
-            st.markdown("<div class='flash-overlay flash-error'></div>", unsafe_allow_html=True)
-            st.markdown(f"""
-                <div style='text-align:center;
+            caja_resultado.markdown(f"<div class='flash-overlay flash-error flash-{n}'></div>", unsafe_allow_html=True)
+            caja_resultado.markdown(f"""
+                <div class='resultado-temporal resultado-{n}' style='text-align:center;
                             background:rgba(231, 76, 60, 0.2);
                             padding:40px;
                             border-radius:20px;
@@ -415,9 +874,9 @@ if menu == "Puerta de Entrada":
                 </div>
             """, unsafe_allow_html=True)
 
-        time.sleep(3.5)
+        # Se muestra una sola vez; la siguiente lectura lo reemplaza de inmediato
         st.session_state.resultado = None
-        st.rerun()
+        servicio.latencias.registrar("render", (time.perf_counter() - t_render) * 1000)
 
 # ================= MÓDULO: REGISTRO DE PRÁCTICAS (DOCENTES) =================
 elif menu == "Registro de Prácticas":
@@ -440,8 +899,7 @@ elif menu == "Registro de Prácticas":
         col1, col2 = st.columns(2)
         
         with col1:
-            taller_sel = st.selectbox("📍 Seleccione el Taller", 
-                                    ["Informática", "Autotronica", "SHYPC", "Contabilidad"])
+            taller_sel = st.selectbox("📍 Seleccione el Taller", TALLERES)
             grupo_sel = st.text_input("👥 Grupo", placeholder="Ej: 402-INFO").upper()
 
         with col2:
@@ -484,82 +942,141 @@ elif menu == "Registro de Prácticas":
     meses_nombres = {1: "Enero", 2: "Febrero", 3: "Marzo", 4: "Abril", 5: "Mayo", 6: "Junio", 
                      7: "Julio", 8: "Agosto", 9: "Septiembre", 10: "Octubre", 11: "Noviembre", 12: "Diciembre"}
     
-    col_f1, col_f2 = st.columns([1, 2])
+    col_f1, col_f2, _ = st.columns([1, 1, 1])
     with col_f1:
         mes_sel = st.selectbox("Filtrar por Mes", options=list(meses_nombres.keys()), 
                                format_func=lambda x: meses_nombres[x], index=fecha_actual.month - 1)
+    with col_f2:
+        anio_sel = st.selectbox("Año", options=list(range(fecha_actual.year, fecha_actual.year - 5, -1)))
 
     try:
-        # Consulta completa para el maestro
-        res_p = supabase.table("practicas_talleres").select("*").eq("maestro", maestro_id).order("fecha", desc=True).execute()
+        # Solo el mes elegido: rango [día 1, día 1 del mes siguiente) sobre el índice (maestro, fecha)
+        inicio_mes = datetime(anio_sel, mes_sel, 1)
+        fin_mes = datetime(anio_sel + mes_sel // 12, mes_sel % 12 + 1, 1)
+        columnas_hist = ['id', 'fecha', 'grupo', 'taller', 'nombre_practica', 'alumnos_asistentes']
+        filas_mes = leer_tabla("practicas_talleres", columnas_hist,
+                               filtros=[("eq", "maestro", maestro_id),
+                                        ("gte", "fecha", inicio_mes.strftime("%Y-%m-%d")),
+                                        ("lt", "fecha", fin_mes.strftime("%Y-%m-%d"))],
+                               clave=("fecha", "id"))
+        df_mes = pd.DataFrame(filas_mes, columns=columnas_hist)
+        df_mes['fecha'] = pd.to_datetime(df_mes['fecha'])
+        df_mes = df_mes.sort_values(['fecha', 'id'], ascending=False)
         
-        if res_p.data:
-            df_full = pd.DataFrame(res_p.data)
-            df_full['fecha'] = pd.to_datetime(df_full['fecha'])
+        if not df_mes.empty:
+            # --- VISTA LIMITADA (Solo los primeros 8 para rapidez visual) ---
+            st.write(f"Mostrando los últimos registros de {meses_nombres[mes_sel]} {anio_sel}:")
+            df_vista = df_mes.head(8) # AQUÍ LIMITAMOS A 8 FILAS
+            
+            st.dataframe(df_vista[['fecha', 'grupo', 'taller', 'nombre_practica', 'alumnos_asistentes']], 
+                         use_container_width=True, hide_index=True)
             
-            # Aplicar filtro de mes para el PDF y la vista
-            df_mes = df_full[df_full['fecha'].dt.month == mes_sel]
+            if len(df_mes) > 8:
+                st.caption(f"Ver más: El PDF descargable contiene los {len(df_mes)} registros del mes.")
+
+            # 4. GENERACIÓN DE PDF INSTITUCIONAL (Usa df_mes para incluir TODO el mes)
+            st.markdown("### 📄 Generar Informe Oficial")
             
-            if not df_mes.empty:
-                # --- VISTA LIMITADA (Solo los primeros 8 para rapidez visual) ---
-                st.write(f"Mostrando los últimos registros de {meses_nombres[mes_sel]}:")
-                df_vista = df_mes.head(8) # AQUÍ LIMITAMOS A 8 FILAS
+            def crear_pdf(datos_df, maestro):
+                pdf = FPDF()
+                pdf.add_page()
+                pdf.set_font("Arial", 'B', 16)
+                pdf.cell(200, 10, "CONALEP CUAUTLA - BITÁCORA DE TALLERES", ln=True, align='C')
+                pdf.set_font("Arial", '', 12)
+                pdf.cell(0, 10, f"Docente: {maestro}", ln=True)
+                pdf.cell(0, 10, f"Periodo: {meses_nombres[mes_sel]} {anio_sel}", ln=True)
+                pdf.ln(5)
                 
-                st.dataframe(df_vista[['fecha', 'grupo', 'taller', 'nombre_practica', 'alumnos_asistentes']], 
-                             use_container_width=True, hide_index=True)
+                # Tabla (encabezado en cada página, prácticas largas en varios renglones)
+                tabla = TablaPDF(pdf, COLUMNAS_BITACORA)
+                tabla.agregar(datos_df.assign(fecha=datos_df['fecha'].dt.strftime('%Y-%m-%d')))
                 
-                if len(df_mes) > 8:
-                    st.caption(f"Ver más: El PDF descargable contiene los {len(df_mes)} registros del mes.")
+                return pdf.output(dest='S').encode('latin-1', 'ignore')
+
+            pdf_data = pdf_diferido("bitacora", [nombre_maestro, mes_sel, anio_sel, df_mes.to_dict("records")],
+                                    lambda: crear_pdf(df_mes, nombre_maestro))
+            st.download_button(
+                label=f"📥 Descargar Reporte Completo ({meses_nombres[mes_sel]} {anio_sel})",
+                data=pdf_data,
+                file_name=f"Bitacora_{maestro_id}_{meses_nombres[mes_sel]}_{anio_sel}.pdf",
+                mime="application/pdf",
+                use_container_width=True
+            )
+        else:
+            st.warning(f"No hay registros encontrados para {meses_nombres[mes_sel]} de {anio_sel}.")
+    except Exception as e:
+        st.error(f"Error al cargar historial: {e}")
 
-                # 4. GENERACIÓN DE PDF INSTITUCIONAL (Usa df_mes para incluir TODO el mes)
-                st.markdown("### 📄 Generar Informe Oficial")
-                
-                def crear_pdf(datos_df, maestro):
+    # 5. EXPORTACIÓN GENERAL (TODOS LOS DOCENTES Y TALLERES)
+    if rol == "ADMIN":
+        st.markdown("---")
+        st.subheader("🏫 Exportación General de Bitácoras")
+
+        try:
+            docentes = sorted({u["usuario"] for u in leer_tabla("usuarios", ["usuario", "rol"], clave="usuario")
+                               if str(u.get("rol", "")).upper().strip() == "DOCENTE"})
+            col_e1, col_e2 = st.columns(2)
+            with col_e1:
+                periodo = st.date_input("Periodo", value=(fecha_actual.date().replace(day=1), fecha_actual.date()))
+                talleres_sel = st.multiselect("Talleres (vacío = todos)", TALLERES)
+            with col_e2:
+                docentes_sel = st.multiselect("Docentes (vacío = todos)", docentes)
+                formato_exp = st.radio("Formato", ["PDF", "XLSX"], horizontal=True)
+
+            if len(periodo) == 2:
+                ini_exp, fin_exp = periodo
+                # Todo el filtrado ocurre en la consulta; las filas llegan por páginas
+                filtros_exp = [("gte", "fecha", ini_exp.strftime("%Y-%m-%d")),
+                               ("lt", "fecha", (fin_exp + timedelta(days=1)).strftime("%Y-%m-%d"))]
+                if talleres_sel:
+                    filtros_exp.append(("in_", "taller", talleres_sel))
+                if docentes_sel:
+                    filtros_exp.append(("in_", "maestro", docentes_sel))
+                campos_exp = [campo for _, campo, _, _ in COLUMNAS_BITACORA_GENERAL]
+
+                def paginas_exportacion():
+                    return leer_paginado("practicas_talleres", campos_exp, filtros_exp, clave=("fecha", "id"))
+
+                def exportar_pdf():
                     pdf = FPDF()
                     pdf.add_page()
                     pdf.set_font("Arial", 'B', 16)
-                    pdf.cell(200, 10, "CONALEP CUAUTLA - BITÁCORA DE TALLERES", ln=True, align='C')
+                    pdf.cell(0, 10, "CONALEP CUAUTLA - BITÁCORA GENERAL DE TALLERES", ln=True, align='C')
                     pdf.set_font("Arial", '', 12)
-                    pdf.cell(0, 10, f"Docente: {maestro}", ln=True)
-                    pdf.cell(0, 10, f"Periodo: {meses_nombres[mes_sel]} {fecha_actual.year}", ln=True)
+                    pdf.cell(0, 10, f"Periodo: {ini_exp.strftime('%d/%m/%Y')} - {fin_exp.strftime('%d/%m/%Y')}", ln=True)
                     pdf.ln(5)
-                    
-                    # Encabezados de tabla
-                    pdf.set_fill_color(30, 132, 73)
-                    pdf.set_text_color(255, 255, 255)
-                    pdf.set_font("Arial", 'B', 10)
-                    pdf.cell(30, 10, "FECHA", 1, 0, 'C', True)
-                    pdf.cell(30, 10, "GRUPO", 1, 0, 'C', True)
-                    pdf.cell(90, 10, "PRÁCTICA", 1, 0, 'C', True)
-                    pdf.cell(40, 10, "ASIST.", 1, 1, 'C', True)
-                    
-                    # Filas de la tabla
-                    pdf.set_text_color(0, 0, 0)
-                    pdf.set_font("Arial", '', 9)
-                    for _, r in datos_df.iterrows():
-                        pdf.cell(30, 8, str(r['fecha'].date()), 1)
-                        pdf.cell(30, 8, str(r['grupo']), 1)
-                        nombre_limpio = str(r['nombre_practica']).encode('latin-1', 'replace').decode('latin-1')
-                        pdf.cell(90, 8, nombre_limpio, 1)
-                        pdf.cell(40, 8, str(r['alumnos_asistentes']), 1, 1)
-                    
+                    tabla = TablaPDF(pdf, COLUMNAS_BITACORA_GENERAL)
+                    for pagina in paginas_exportacion():
+                        tabla.agregar(pd.DataFrame(pagina, columns=campos_exp))
+                    if not tabla.filas:
+                        pdf.cell(0, 10, "Sin registros en el periodo seleccionado.", ln=True)
                     return pdf.output(dest='S').encode('latin-1', 'ignore')
 
-                pdf_data = crear_pdf(df_mes, nombre_maestro)
-                st.download_button(
-                    label=f"📥 Descargar Reporte Completo ({meses_nombres[mes_sel]})",
-                    data=pdf_data,
-                    file_name=f"Bitacora_{maestro_id}_{meses_nombres[mes_sel]}.pdf",
-                    mime="application/pdf",
-                    use_container_width=True
-                )
+                def exportar_xlsx():
+                    wb = Workbook(write_only=True)
+                    hoja = wb.create_sheet("Bitacora")
+                    hoja.append([titulo for titulo, _, _, _ in COLUMNAS_BITACORA_GENERAL])
+                    for pagina in paginas_exportacion():
+                        for fila in pagina:
+                            hoja.append([fila.get(campo) for campo in campos_exp])
+                    buf = BytesIO()
+                    wb.save(buf)
+                    return buf.getvalue()
+
+                nombre_exp = f"Bitacora_General_{ini_exp.strftime('%Y%m%d')}_{fin_exp.strftime('%Y%m%d')}"
+                if formato_exp == "PDF":
+                    st.download_button("📥 Descargar Bitácora General (PDF)", data=exportar_pdf,
+                                       file_name=f"{nombre_exp}.pdf", mime="application/pdf",
+                                       use_container_width=True)
+                else:
+                    st.download_button("📥 Descargar Bitácora General (XLSX)", data=exportar_xlsx,
+                                       file_name=f"{nombre_exp}.xlsx",
+                                       mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                                       use_container_width=True)
             else:
-                st.warning(f"No hay registros encontrados para el mes de {meses_nombres[mes_sel]}.")
-        else:
-            st.info("Aún no tienes prácticas registradas en el sistema.")
-            
-    except Exception as e:
-        st.error(f"Error al cargar historial: {e}")
+                st.info("Seleccione fecha inicial y final del periodo.")
+        except Exception as e:
+            st.error(f"Error en la exportación general: {e}")
 
 
 
@@ -573,7 +1090,7 @@ elif menu == "Gestión de Accesos":
         </div>
     """, unsafe_allow_html=True)
 
-    tab_gafete, tab_registro, tab_eliminar = st.tabs(["🔑 Generar Acceso Inteligente", "➕ Registrar Nuevo", "🗑️ Eliminar Personal"])
+    tab_gafete, tab_registro, tab_eliminar, tab_importar = st.tabs(["🔑 Generar Acceso Inteligente", "➕ Registrar Nuevo", "🗑️ Eliminar Personal", "📥 Importar Alumnos"])
 
     # --- PESTAÑA 1: GENERADOR DE CARNET ---
     with tab_gafete:
@@ -585,10 +1102,7 @@ elif menu == "Gestión de Accesos":
                 u_db, p_db, r_db = doc['usuario'], doc['pin'], doc['rol']
                 
                 url_final = f"https://sica-conalep-yxadaappyp3kz3hcarykgx3.streamlit.app/?u={u_db}&p={p_db}"
-                qr = qrcode.make(url_final)
-                buf_qr = BytesIO()
-                qr.save(buf_qr, format="PNG")
-                qr_img_bytes = buf_qr.getvalue()
+                qr_img_bytes = generar_qr_png(url_final)
 
                 # Vista Previa
                 st.markdown(f"""
@@ -601,7 +1115,7 @@ elif menu == "Gestión de Accesos":
                 st.image(qr_img_bytes, width=150)
 
                 def generar_pdf_v3(u, r, img_bytes):
-                    pdf = FPDF(orientation='L', unit='mm', format=(55, 85))
+                    pdf = FPDFMemoria(orientation='L', unit='mm', format=(55, 85))
                     pdf.set_auto_page_break(auto=False, margin=0)
                     pdf.add_page()
                     pdf.set_fill_color(22, 27, 34); pdf.rect(0, 0, 85, 55, 'F')
@@ -611,8 +1125,7 @@ elif menu == "Gestión de Accesos":
                     u_pdf = u.encode('latin-1', 'replace').decode('latin-1').upper()
                     pdf.multi_cell(45, 7, u_pdf, align='L')
                     pdf.set_xy(7, 38); pdf.set_fill_color(30, 132, 73); pdf.set_font("Arial", 'B', 9); pdf.cell(30, 6, f"  {r}", 0, 0, 'L', True)
-                    with open("temp.png", "wb") as f: f.write(img_bytes)
-                    pdf.image("temp.png", x=50, y=10, w=30)
+                    pdf.imagen_png(img_bytes, x=50, y=10, w=30)
                     return pdf.output(dest='S').encode('latin-1', 'ignore')
 
                 st.download_button("📥 Descargar llave PDF", generar_pdf_v3(u_db, r_db, qr_img_bytes), f"Carnet_{u_db}.pdf", "application/pdf")
@@ -633,6 +1146,7 @@ elif menu == "Gestión de Accesos":
                     data = {"usuario": new_user, "pin": new_pin, "rol": new_rol}
                     try:
                         supabase.table("usuarios").insert(data).execute()
+                        invalidar_consultas("usuarios")
                         st.success(f"¡Usuario {new_user} registrado correctamente!")
                     except Exception as e:
                         st.error(f"Error al registrar: {e}")
@@ -647,16 +1161,71 @@ elif menu == "Gestión de Accesos":
             if u_del:
                 confirm = st.warning(f"¿Seguro que deseas eliminar a {u_del}?")
                 res_del = supabase.table("usuarios").delete().eq("usuario", u_del).execute()
+                invalidar_consultas("usuarios")
                 if res_del.data:
                     st.success(f"Usuario {u_del} ha sido eliminado.")
                 else:
                     st.error("No se encontró el usuario para eliminar.")
 
+    # --- PESTAÑA 4: IMPORTAR PADRÓN DE ALUMNOS ---
+    with tab_importar:
+        st.subheader("📥 Importar Padrón de Alumnos")
+        st.caption("Columnas: MATRICULA, NOMBRE, GRUPO y opcionalmente ESTATUS (ACTIVO / BAJA). "
+                   "Solo se guardan los alumnos nuevos o los que cambiaron.")
+        archivo_padron = st.file_uploader("Archivo de inscripción", type=["xlsx", "csv"], key="archivo_padron")
+        if archivo_padron:
+            try:
+                t0 = time.perf_counter()
+                del_archivo, trae_estatus, descartadas = leer_archivo_padron(archivo_padron, archivo_padron.name)
+                actuales = {a["matricula"]: a for pagina in leer_paginado("alumnos", COLUMNAS_PADRON, clave="matricula")
+                            for a in pagina}
+                nuevos, actualizados, cambios_estatus = diferencias_padron(del_archivo, actuales)
+                t_dif = time.perf_counter() - t0
+
+                c1, c2, c3, c4 = st.columns(4)
+                c1.metric("En el archivo", len(del_archivo))
+                c2.metric("Nuevos", len(nuevos))
+                c3.metric("Con cambios", len(actualizados))
+                c4.metric("Cambios de estatus", len(cambios_estatus))
+                st.caption(f"Comparado contra {len(actuales)} alumnos en {t_dif:.1f} s"
+                           + (f" · {descartadas} filas sin matrícula ignoradas" if descartadas else "")
+                           + ("" if trae_estatus else " · sin columna ESTATUS, los nuevos quedan activos"))
+
+                if nuevos or actualizados:
+                    with st.expander("👁️ Vista previa de cambios"):
+                        st.dataframe(pd.DataFrame((nuevos + actualizados)[:200]), use_container_width=True, hide_index=True)
+
+                    if st.button("✅ Aplicar cambios al padrón", type="primary"):
+                        enviados, fallidos = 0, []
+                        for filas in (nuevos, actualizados):
+                            if filas:
+                                ok, err = enviar_lote("alumnos", filas, on_conflict="matricula", fusionar=True)
+                                enviados += ok
+                                fallidos.extend(err)
+                        # Los demás kioskos lo toman del refresco incremental por updated_at
+                        padron = padron_alumnos()
+                        con_error = {r["matricula"] for r, _ in fallidos}
+                        for fila in nuevos + actualizados:
+                            if fila["matricula"] not in con_error:
+                                padron.actualizar(fila["matricula"], fila)
+                        if fallidos:
+                            st.warning(f"Se aplicaron {enviados} cambios; {len(fallidos)} filas fallaron.")
+                            st.dataframe(pd.DataFrame([{"MATRICULA": r["matricula"], "ERROR": e} for r, e in fallidos[:100]]),
+                                         use_container_width=True, hide_index=True)
+                        else:
+                            st.success(f"¡Padrón actualizado! {enviados} alumnos guardados.")
+                else:
+                    st.success("El padrón ya está al día, no hay nada que aplicar.")
+            except ValueError as e:
+                st.error(str(e))
+            except Exception as e:
+                st.error(f"Error al importar: {e}")
+
     # LISTA DE USUARIOS SIEMPRE VISIBLE ABAJO
     st.markdown("---")
-    res_all = supabase.table("usuarios").select("usuario, rol, pin").execute()
-    if res_all.data:
-        st.dataframe(pd.DataFrame(res_all.data), use_container_width=True, hide_index=True)
+    lista_usuarios = leer_tabla("usuarios", ["usuario", "rol", "pin"], clave="usuario")
+    if lista_usuarios:
+        st.dataframe(pd.DataFrame(lista_usuarios, columns=["usuario", "rol", "pin"]), use_container_width=True, hide_index=True)
   # ================= MÓDULO: CREDENCIAL DIGITAL =================
 elif menu == "Credencial Digital":
     st.markdown("""
@@ -711,10 +1280,7 @@ elif menu == "Credencial Digital":
                 grupo_al = alumno['grupo']
 
                 # 1. GENERAR QR
-                qr = qrcode.make(matricula)
-                buf_qr = BytesIO()
-                qr.save(buf_qr, format="PNG")
-                qr_bytes = buf_qr.getvalue()
+                qr_bytes = generar_qr_png(matricula)
 
                 # 2. PREVISUALIZACIÓN EN APP
                 st.markdown("### 👀 Previsualización de Credencial")
@@ -733,58 +1299,10 @@ elif menu == "Credencial Digital":
                 
                 st.image(qr_bytes, width=130, caption="QR de Identificación")
 
-                # 3. FUNCIÓN PDF TAMAÑO CREDENCIAL (85x55mm)
-                def generar_pdf_alumno_final(nom, grp, mat, img_q):
-                    pdf = FPDF(orientation='L', unit='mm', format=(55, 85))
-                    pdf.set_auto_page_break(auto=False, margin=0) 
-                    pdf.add_page()
-                    
-                    # Fondo y Franjas
-                    pdf.set_fill_color(22, 27, 34)
-                    pdf.rect(0, 0, 85, 55, 'F')
-                    pdf.set_fill_color(30, 132, 73)
-                    pdf.rect(0, 0, 85, 4, 'F') # Superior
-                    pdf.rect(0, 51, 85, 4, 'F') # Inferior
-                    
-                    # Espacio para Foto
-                    pdf.set_fill_color(40, 44, 52)
-                    pdf.rect(6, 10, 22, 28, 'F')
-                    pdf.set_text_color(100, 100, 100)
-                    pdf.set_font("Arial", 'B', 15)
-                    pdf.set_xy(6, 18)
-                    pdf.cell(22, 10, "FOTO", 0, 0, 'C')
-
-                    # --- GRUPO: INFERIOR IZQUIERDA (Debajo de la foto) ---
-                    pdf.set_xy(6, 42)
-                    pdf.set_font("Arial", 'B', 11)
-                    pdf.set_text_color(30, 132, 73)
-                    pdf.cell(30, 5, f"{grp}", ln=False, align='L')
-
-                    # Datos Institucionales y Nombre
-                    pdf.set_text_color(255, 255, 255)
-                    pdf.set_font("Arial", 'B', 8)
-                    pdf.set_xy(32, 8)
-                    pdf.cell(0, 5, "CONALEP CUAUTLA", ln=True)
-                    
-                    pdf.set_xy(32, 16)
-                    pdf.set_font("Arial", 'B', 12)
-                    nom_p = nom.encode('latin-1', 'replace').decode('latin-1').upper()
-                    # Ancho de 48mm para que no choque con el QR
-                    pdf.multi_cell(48, 6, nom_p, align='L')
-
-                    # --- QR POSICIONADO A LA DERECHA (Sin reducir tamaño) ---
-                    with open("temp_qr_al.png", "wb") as f: f.write(img_q)
-                    # x=58 permite que el QR de 22mm quepa perfecto sin tapar el texto
-                    pdf.image("temp_qr_al.png", x=58, y=26, w=22)
-                    
-                    # Borde de Corte
-                    pdf.set_draw_color(60, 60, 60)
-                    pdf.rect(0, 0, 85, 55, 'D')
-                    
-                    return pdf.output(dest='S').encode('latin-1', 'ignore')
-
+                # 3. PDF TAMAÑO CREDENCIAL (85x55mm), ver credenciales.py
                 # Botón de Descarga
-                pdf_data = generar_pdf_alumno_final(nombre_al, grupo_al, matricula, qr_bytes)
+                pdf_data = pdf_diferido("credencial", [nombre_al, grupo_al, matricula],
+                                        lambda: generar_pdf_alumno_final(nombre_al, grupo_al, matricula, qr_bytes))
                 st.download_button(
                     label=f"📥 Descargar Credencial PDF ({matricula})",
                     data=pdf_data,
@@ -792,6 +1310,47 @@ elif menu == "Credencial Digital":
                     mime="application/pdf",
                     use_container_width=True
                 )
+
+    # ================= IMPRESIÓN MASIVA POR GRUPO =================
+    st.markdown("---")
+    st.subheader("🖨️ Impresión por Grupo")
+    try:
+        grupos_disp = sorted({a["grupo"] for a in leer_tabla("alumnos", ["grupo"], clave="matricula") if a.get("grupo")})
+        grupos_sel = st.multiselect("Grupos a imprimir", grupos_disp)
+        formato_lote = st.radio("Formato", ["Una credencial por página", "Hoja A4 (10 por hoja)"], horizontal=True)
+
+        if grupos_sel and st.button("⚙️ Generar credenciales del grupo", use_container_width=True):
+            # Un solo viaje por el padrón de los grupos elegidos
+            alumnos_lote = [f for pagina in leer_paginado("alumnos", ["matricula", "nombre", "grupo", "estatus"],
+                                                          filtros=[("in_", "grupo", grupos_sel)], clave="matricula")
+                            for f in pagina]
+            bloqueados = sum(1 for a in alumnos_lote if a.get("estatus") is False)
+            alumnos_lote = sorted((a for a in alumnos_lote if a.get("estatus") is not False),
+                                  key=lambda a: (a.get("grupo") or "", a.get("nombre") or ""))
+
+            if not alumnos_lote:
+                st.warning("Los grupos seleccionados no tienen alumnos activos.")
+            else:
+                # Los QR se dejan listos aquí (con barra); el PDF se arma al
+                # hacer clic en descargar, ya con los QR en caché.
+                barra = st.progress(0.0, text="Generando códigos QR...")
+                qrs_en_paralelo([a["matricula"] for a in alumnos_lote],
+                                al_avanzar=lambda hechos, total: barra.progress(hechos / total, text=f"QR {hechos}/{total}"))
+                barra.empty()
+                hoja_a4 = formato_lote.startswith("Hoja")
+                st.success(f"✅ {len(alumnos_lote)} credenciales listas para descargar"
+                           + (f" ({bloqueados} alumnos bloqueados omitidos)" if bloqueados else ""))
+                st.download_button(
+                    label=f"📥 Descargar Credenciales ({', '.join(grupos_sel)})",
+                    data=pdf_diferido("lote_credenciales", [hoja_a4, alumnos_lote],
+                                      lambda: lote_credenciales(alumnos_lote, hoja_a4=hoja_a4)),
+                    file_name=f"Credenciales_{'_'.join(grupos_sel)}.pdf",
+                    mime="application/pdf",
+                    on_click="ignore",
+                    use_container_width=True
+                )
+    except Exception as e:
+        st.error(f"Error al generar credenciales: {e}")
 # ================= MÓDULO: REPORTES =================
 elif menu == "Reportes":
     st.title("🚨 Gestión de Reportes")
@@ -808,6 +1367,14 @@ elif menu == "Reportes":
     # Cada widget tendrá una key única basada en el contador
     suffix = f"_{st.session_state.form_reset_count}"
 
+    fotos_pendientes = cola_evidencias().pendientes()
+    if fotos_pendientes:
+        st.caption(f"⏳ {fotos_pendientes} foto(s) de evidencia subiéndose en segundo plano")
+    fotos_rechazadas = cola_evidencias().rechazadas()
+    if fotos_rechazadas and rol == "ADMIN":
+        st.caption(f"⚠️ {fotos_rechazadas} foto(s) rechazadas por Storage quedaron apartadas "
+                   f"en la tabla 'rechazadas' de {cola_evidencias().ruta}")
+
     # 1. Entrada de Matrícula (con key dinámica)
     mat_rep = st.text_input("Ingrese Matrícula del Alumno", key=f"mat{suffix}").strip().upper()
     
@@ -827,12 +1394,13 @@ elif menu == "Reportes":
                 """, unsafe_allow_html=True)
                 
                 # Lógica 3+1
-                historial_rep = supabase.table("reportes").select("id", count="exact").eq("matricula", mat_rep).execute()
-                total_previo = historial_rep.count if historial_rep.count is not None else 0
-                niveles = ["LLAMADA 1", "LLAMADA 2", "LLAMADA 3"]
-                nivel_sugerido = niveles[total_previo] if total_previo < 3 else "REPORTE"
+                inc = incidencias_alumno(mat_rep)
+                nivel_actual = nivel_sugerido(inc["total"])
 
-                st.info(f"Registro actual detectado: {nivel_sugerido}")
+                st.info(f"Registro actual detectado: {nivel_actual}")
+                if inc.get("ultima_fecha"):
+                    st.caption(f"Reportes previos: {inc['total']} · último: {inc.get('ultimo_nivel') or '-'} "
+                               f"el {inc['ultima_fecha']}")
 
                 # Widgets con key dinámica para evitar errores al limpiar
                 tipo = st.selectbox("Tipo de falta", ["Uniforme", "Conducta", "Retardo", "Celular", "Otro"], key=f"tipo{suffix}")
@@ -844,29 +1412,41 @@ elif menu == "Reportes":
                 with col1:
                     if st.button("💾 Guardar Registro", use_container_width=True):
                         url_foto = ""
+                        foto_jpg = None
                         
-                        # Subida de foto
+                        # La foto se comprime aquí y se sube en segundo plano
                         if foto is not None:
                             try:
                                 nombre_archivo = f"evidencia_{mat_rep}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                                supabase.storage.from_("evidencias").upload(nombre_archivo, foto.getvalue())
-                                url_foto = supabase.storage.from_("evidencias").get_public_url(nombre_archivo)
+                                foto_jpg = comprimir_evidencia(foto.getvalue())
+                                url_foto = PREFIJO_FOTO_PENDIENTE + nombre_archivo
                             except Exception as e:
-                                st.error(f"Error al subir foto: {e}")
+                                st.error(f"Error al procesar foto: {e}")
 
                         # Envío a la base de datos
                         try:
-                            # Reutilizamos tu función enviar (asegúrate que esté definida arriba)
-                            enviar("reportes", {
-                                "fecha": datetime.now(zona).strftime("%Y-%m-%d"),
-                                "matricula": mat_rep,
-                                "nombre": nombre_alumno,
-                                "nivel": nivel_sugerido,
-                                "tipo": tipo,
-                                "descripcion": desc,
-                                "foto_url": url_foto,
-                                "registrado_por": user.get("usuario", "Prefecto")
-                            })
+                            # La foto va al diario antes del reporte: si el servidor se cae
+                            # entre los dos pasos, ningún reporte queda con una marca
+                            # "pendiente:" que nadie va a reemplazar
+                            if foto_jpg:
+                                cola_evidencias().encolar(nombre_archivo, foto_jpg)
+                            try:
+                                # Reutilizamos tu función enviar (asegúrate que esté definida arriba)
+                                enviar("reportes", {
+                                    "fecha": datetime.now(zona).strftime("%Y-%m-%d"),
+                                    "matricula": mat_rep,
+                                    "nombre": nombre_alumno,
+                                    "nivel": nivel_actual,
+                                    "tipo": tipo,
+                                    "descripcion": desc,
+                                    "foto_url": url_foto,
+                                    "registrado_por": user.get("usuario", "Prefecto")
+                                })
+                            except Exception:
+                                # Sin reporte la foto no tiene a dónde ir
+                                if foto_jpg:
+                                    cola_evidencias().descartar(nombre_archivo)
+                                raise
                             
                             st.success("✅ Registro y evidencia guardados correctamente.")
                             time.sleep(1.2)
@@ -907,19 +1487,21 @@ elif menu == "Historial":
                 tab1, tab2 = st.tabs(["🕒 Registro de Entradas", "🚨 Reportes"])
                 
                 with tab1:
-                    res_ent = supabase.table("entradas").select("fecha, hora").eq("matricula", mat_h).order("fecha", desc=True).execute()
-                    if res_ent.data:
-                        df_ent = pd.DataFrame(res_ent.data)
+                    v_ent = ventana_historial("entradas", "id, fecha, hora", mat_h)
+                    if v_ent["filas"]:
+                        df_ent = pd.DataFrame(v_ent["filas"], columns=["fecha", "hora"])
                         df_ent.columns = ["FECHA", "HORA"]
                         st.dataframe(df_ent, use_container_width=True)
+                        boton_cargar_mas(v_ent, "entradas", "id, fecha, hora", mat_h, "mas_entradas_historial")
                     else:
                         st.info("Sin registros de asistencia.")
 
                 with tab2:
-                    res_rep = supabase.table("reportes").select("fecha, nivel, tipo, descripcion, registrado_por, foto_url").eq("matricula", mat_h).order("fecha", desc=True).execute()
+                    cols_rep = "id, fecha, nivel, tipo, descripcion, registrado_por, foto_url, miniatura_url"
+                    v_rep = ventana_historial("reportes", cols_rep, mat_h)
                     
-                    if res_rep.data:
-                        for rep in res_rep.data:
+                    if v_rep["filas"]:
+                        for rep in v_rep["filas"]:
                             with st.container():
                                 # Ajustamos columnas para mejor visibilidad en móviles
                                 col_texto, col_foto = st.columns([3, 1.2])
@@ -932,18 +1514,26 @@ elif menu == "Historial":
                                 
                                 with col_foto:
                                     url = rep.get("foto_url")
-                                    if url and str(url).strip() != "":
-                                        # Imagen interactiva con HTML
-                                        st.markdown(f"""
-                                            <a href="{url}" target="_blank">
-                                                <img src="{url}" style="width:100%; border-radius:10px; border: 1px solid #30363d; margin-bottom: 5px;">
-                                            </a>
-                                        """, unsafe_allow_html=True)
+                                    if str(url or "").startswith(PREFIJO_FOTO_PENDIENTE):
+                                        st.info("⏳ Evidencia subiéndose")
+                                    elif url and str(url).strip() != "":
+                                        # En la lista solo va la miniatura; la foto completa se abre al dar clic
+                                        miniatura = rep.get("miniatura_url")
+                                        if miniatura:
+                                            st.markdown(f"""
+                                                <a href="{url}" target="_blank">
+                                                    <img src="{miniatura}" loading="lazy" style="width:100%; border-radius:10px; border: 1px solid #30363d; margin-bottom: 5px;">
+                                                </a>
+                                            """, unsafe_allow_html=True)
+                                        else:
+                                            cola_evidencias().pedir_miniatura(url)
+                                            st.markdown(f"<a href='{url}' target='_blank'>🖼️ Ver evidencia</a>", unsafe_allow_html=True)
                                         st.caption("🔍 Ampliar foto")
                                     else:
                                         st.info("Sin evidencia")
                                 
                                 st.divider()
+                        boton_cargar_mas(v_rep, "reportes", cols_rep, mat_h, "mas_reportes_historial")
                     else:
                         st.write("El alumno no cuenta con reportes registrados.")
             else:
@@ -1014,6 +1604,7 @@ elif menu == "Avisos":
                                 
                                 # Usamos tu función enviar o insert directo
                                 supabase.table("avisos").insert(datos_aviso).execute()
+                                invalidar_consultas("avisos")
                                 
                                 st.balloons()
                                 st.success(f"✅ Aviso publicado para {al['nombre']}.")
@@ -1033,6 +1624,7 @@ elif menu == "Avisos":
                         c1.warning(f"**{av['prioridad']}**: {av['mensaje']}")
                         if c2.button("Eliminar", key=f"del_{av['id']}"):
                             supabase.table("avisos").update({"activo": False}).eq("id", av['id']).execute()
+                            invalidar_consultas("avisos")
                             st.rerun()
                 else:
                     st.write("No hay avisos activos para este alumno.")
@@ -1047,43 +1639,18 @@ elif menu == "Dashboard":
     st.markdown("---")
 
     try:
-        # 1. CARGA DE DATOS
-        res_rep = supabase.table("reportes").select("*").execute()
-        res_ent = supabase.table("entradas").select("*").execute()
-        res_al = supabase.table("alumnos").select("matricula, grupo").execute()
-
-        if res_rep.data and res_ent.data and res_al.data:
-            df_rep = pd.DataFrame(res_rep.data)
-            df_ent = pd.DataFrame(res_ent.data)
-            df_al = pd.DataFrame(res_al.data)
-
-            # 2. NORMALIZACIÓN DE COLUMNAS (Forzar minúsculas y quitar espacios)
-            df_rep.columns = [c.lower().strip() for c in df_rep.columns]
-            df_al.columns = [c.lower().strip() for c in df_al.columns]
-            df_ent.columns = [c.lower().strip() for c in df_ent.columns]
-
-            # 3. UNIÓN Y CREACIÓN FORZOSA DE LA COLUMNA GRUPO
-            # Si 'grupo' ya existe en reportes, la quitamos para traer la oficial de alumnos
-            if 'grupo' in df_rep.columns:
-                df_rep = df_rep.drop(columns=['grupo'])
-            
-            # Realizamos el cruce de tablas
-            df_rep = df_rep.merge(df_al[['matricula', 'grupo']], on="matricula", how="left")
-            
-            # REGLA DE ORO: Si después del merge no hay grupo, lo creamos como "SIN GRUPO"
-            if 'grupo' not in df_rep.columns:
-                df_rep['grupo'] = "SIN GRUPO"
-            else:
-                df_rep['grupo'] = df_rep['grupo'].fillna("SIN GRUPO")
+        # 1. CARGA DE DATOS (ya agregados en la base, ver sql/004_resumen_dashboard.sql)
+        # Las entradas del kiosko no invalidan: el resumen se renueva cada TTL_CONSULTAS
+        resumen = en_cache(("reportes", "entradas", "alumnos"), ("rpc", "resumen_dashboard"),
+                           lambda: supabase.rpc("resumen_dashboard").execute().data)
 
+        if resumen and resumen["total_reportes"] and resumen["total_entradas"]:
             # --- SECCIÓN DE MÉTRICAS ---
             c1, c2, c3, c4 = st.columns(4)
-            total_ent = len(df_ent)
-            total_inc = len(df_rep)
-            # Buscamos 'nivel' de forma segura
-            col_niv = 'nivel' if 'nivel' in df_rep.columns else None
-            graves = len(df_rep[df_rep[col_niv].astype(str).str.upper() == 'REPORTE']) if col_niv else 0
-            motivo = df_rep['tipo'].mode()[0] if not df_rep.empty and 'tipo' in df_rep.columns else "N/A"
+            total_ent = resumen["total_entradas"]
+            total_inc = resumen["total_reportes"]
+            graves = resumen["casos_graves"]
+            motivo = resumen["motivo_comun"] or "N/A"
 
             c1.metric("Asistencias", total_ent)
             c2.metric("Incidencias", total_inc, delta="Alerta", delta_color="inverse")
@@ -1096,9 +1663,7 @@ elif menu == "Dashboard":
 
             with col_a:
                 st.subheader("Reportes por Grupo")
-                # Preparamos los datos para la gráfica asegurando que existan
-                df_graf_grupos = df_rep['grupo'].value_counts().reset_index()
-                df_graf_grupos.columns = ['grupo', 'conteo']
+                df_graf_grupos = pd.DataFrame(resumen["reportes_por_grupo"], columns=['grupo', 'conteo'])
                 
                 fig_grupos = px.bar(df_graf_grupos, 
                                    x='conteo', y='grupo', orientation='h',
@@ -1108,13 +1673,12 @@ elif menu == "Dashboard":
 
             with col_b:
                 st.subheader("Tendencia de Asistencia")
-                if 'fecha' in df_ent.columns:
-                    df_ent['fecha'] = pd.to_datetime(df_ent['fecha'])
-                    asistencia_diaria = df_ent.groupby('fecha').size().reset_index(name='asistencias')
-                    fig_asistencia = px.line(asistencia_diaria, x='fecha', y='asistencias', markers=True)
-                    fig_asistencia.update_traces(line_color='#1e8449')
-                    fig_asistencia.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', font_color="white")
-                    st.plotly_chart(fig_asistencia, use_container_width=True)
+                asistencia_diaria = pd.DataFrame(resumen["asistencia_diaria"], columns=['fecha', 'asistencias'])
+                asistencia_diaria['fecha'] = pd.to_datetime(asistencia_diaria['fecha'])
+                fig_asistencia = px.line(asistencia_diaria, x='fecha', y='asistencias', markers=True)
+                fig_asistencia.update_traces(line_color='#1e8449')
+                fig_asistencia.update_layout(paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', font_color="white")
+                st.plotly_chart(fig_asistencia, use_container_width=True)
 
             # --- EXPORTACIÓN Y WHATSAPP ---
             st.markdown("---")
@@ -1133,6 +1697,16 @@ elif menu == "Dashboard":
         else:
             st.info("No hay suficientes datos registrados para generar el Dashboard.")
 
+        # Tendencia de asistencia: sale de 'asistencia_resumen' (sql/005_asistencia_resumen.sql)
+        if rol == "ADMIN":
+            with st.expander("🛠️ Mantenimiento del resumen de asistencia"):
+                desde_resumen = st.date_input("Recalcular desde (vacío = todo el historial)", value=None)
+                if st.button("🔄 Reconstruir resumen"):
+                    params = {"p_desde": desde_resumen.strftime("%Y-%m-%d")} if desde_resumen else {}
+                    filas = supabase.rpc("reconstruir_asistencia_resumen", params).execute().data
+                    invalidar_consultas("entradas")
+                    st.success(f"Resumen reconstruido: {filas} filas.")
+
     except Exception as e:
         st.error(f"Error al generar Dashboard: {e}")
 # ================= CONFIGURACIÓN INICIAL =================
@@ -1141,26 +1715,25 @@ elif menu == "Servicios y Técnica":
     st.markdown("---")
 
     try:
-        # 1. CARGA DE DATOS
-        res_rep = supabase.table("reportes").select("*").execute()
-        res_al = supabase.table("alumnos").select("*").execute()
+        # 1. CARGA DE DATOS (por páginas, contando sin guardar las filas)
+        def contar_reportes():
+            conteo_personal, conteo_alumnos = Counter(), Counter()
+            for pagina in leer_paginado("reportes", ["registrado_por", "matricula"]):
+                conteo_personal.update(f["registrado_por"] for f in pagina if f.get("registrado_por"))
+                conteo_alumnos.update(f["matricula"] for f in pagina if f.get("matricula"))
+            return conteo_personal, conteo_alumnos
+
+        conteo_personal, conteo_alumnos = en_cache(("reportes",), ("servicios", "conteos"), contar_reportes)
         
-        if res_rep.data and res_al.data:
-            df_rep = pd.DataFrame(res_rep.data)
-            df_al = pd.DataFrame(res_al.data)
-
-            # Normalización
-            df_rep.columns = [c.lower().strip() for c in df_rep.columns]
-            df_al.columns = [c.lower().strip() for c in df_al.columns]
-
+        if conteo_alumnos:
             # --- SECCIÓN: PRODUCTIVIDAD DE PREFECTURA Y PERSONAL ---
             st.subheader("👮 Control de Desempeño Operativo")
             st.info("Métricas de reportes generados por cada miembro del personal.")
 
-            if 'registrado_por' in df_rep.columns:
+            if conteo_personal:
                 # Calculamos el conteo por persona
-                prod_personal = df_rep['registrado_por'].value_counts().reset_index()
-                prod_personal.columns = ['Personal / Prefecto', 'Total Reportes']
+                prod_personal = pd.DataFrame(conteo_personal.most_common(),
+                                             columns=['Personal / Prefecto', 'Total Reportes'])
                 
                 col_m1, col_m2 = st.columns([2, 1])
                 
@@ -1182,24 +1755,24 @@ elif menu == "Servicios y Técnica":
                 # --- FILTRO POR PREFECTO ---
                 st.markdown("---")
                 st.subheader("🔍 Consultar Trabajo por Persona")
-                lista_personal = df_rep['registrado_por'].unique()
+                lista_personal = prod_personal['Personal / Prefecto'].tolist()
                 prefecto_sel = st.selectbox("Seleccione al Prefecto/Personal para ver su detalle:", lista_personal)
                 
                 if prefecto_sel:
-                    detalle_pref = df_rep[df_rep['registrado_por'] == prefecto_sel]
-                    st.write(f"Mostrando los últimos {len(detalle_pref)} reportes levantados por **{prefecto_sel}**:")
                     # Mostramos columnas clave para Servicios Escolares
-                    columnas_ver = [c for c in ['fecha', 'matricula', 'nombre', 'tipo', 'nivel'] if c in detalle_pref.columns]
-                    st.dataframe(detalle_pref[columnas_ver], use_container_width=True, hide_index=True)
+                    columnas_ver = ['fecha', 'matricula', 'nombre', 'tipo', 'nivel']
+                    filas_pref = leer_tabla("reportes", columnas_ver, filtros=[("eq", "registrado_por", prefecto_sel)])
+                    detalle_pref = pd.DataFrame(filas_pref, columns=columnas_ver)
+                    st.write(f"Mostrando los últimos {len(detalle_pref)} reportes levantados por **{prefecto_sel}**:")
+                    st.dataframe(detalle_pref, use_container_width=True, hide_index=True)
 
             else:
-                st.warning("No se ha detectado la columna 'registrado_por' en la base de datos de reportes.")
+                st.warning("Ningún reporte tiene capturado el campo 'registrado_por'.")
 
             # --- SECCIÓN: ALUMNOS EN SEGUIMIENTO ---
             st.markdown("---")
             st.subheader("📋 Lista de Alumnos en Riesgo")
-            conteo_al = df_rep['matricula'].value_counts().reset_index()
-            conteo_al.columns = ['matricula', 'Total']
+            conteo_al = pd.DataFrame(conteo_alumnos.most_common(), columns=['matricula', 'Total'])
             alumnos_riesgo = conteo_al[conteo_al['Total'] >= 2]
             st.table(alumnos_riesgo.head(10))
 
@@ -1219,28 +1792,37 @@ elif menu == "Expediente Digital":
 
     if mat_exp:
         try:
-            # 1. CARGA DE DATOS (Primero traemos todo de la base de datos)
-            al_res = supabase.table("alumnos").select("*").eq("matricula", mat_exp).execute()
+            # 1. CARGA DE DATOS (todas las consultas a la vez, solo dependen de la matrícula)
+            cache = cache_consultas()
+            datos, errores = consultar_en_paralelo({
+                "alumno": lambda c: c.table("alumnos").select("*").eq("matricula", mat_exp).execute().data,
+                "reportes": lambda c: primera_ventana("reportes", "*", mat_exp, cache=cache, cliente=c),
+                "entradas": lambda c: primera_ventana("entradas", "*", mat_exp, cache=cache, cliente=c),
+                "avisos": lambda c: c.table("avisos").select("*").eq("matricula", mat_exp).eq("activo", True).execute().data,
+                "incidencias": lambda c: incidencias_alumno(mat_exp, cliente=c),
+            }, TIEMPO_MAXIMO_EXPEDIENTE)
+            if "alumno" in errores:
+                raise RuntimeError(f"alumnos: {errores['alumno']}")
             
-            if al_res.data:
-                al = al_res.data[0]
+            if datos["alumno"]:
+                al = datos["alumno"][0]
                 estatus_actual = al.get("estatus", True)
+                for tabla, error in errores.items():
+                    st.warning(f"No se pudo cargar '{tabla}': {error}")
                 
-                # Consultas a tablas relacionadas
-                res_rep = supabase.table("reportes").select("*").eq("matricula", mat_exp).execute()
-                res_ent = supabase.table("entradas").select("*").eq("matricula", mat_exp).execute()
-                res_av = supabase.table("avisos").select("*").eq("matricula", mat_exp).eq("activo", True).execute()
+                # Consultas a tablas relacionadas (solo las ventanas más recientes)
+                v_rep = ventana_historial("reportes", "*", mat_exp, primera=datos.get("reportes", ([], False)))
+                v_ent = ventana_historial("entradas", "*", mat_exp, primera=datos.get("entradas", ([], False)))
+                # Sin resumen de incidencias el riesgo se estima con lo que sí se cargó
+                inc = datos.get("incidencias") or {"total": len(v_rep["filas"]), "ultimo_nivel": None, "ultima_fecha": None}
                 
                 # DEFINICIÓN DE VARIABLES (Aseguramos que existan antes de que el PDF las pida)
-                df_rep = pd.DataFrame(res_rep.data) if res_rep.data else pd.DataFrame()
-                df_ent = pd.DataFrame(res_ent.data) if res_ent.data else pd.DataFrame()
-                list_av = res_av.data if res_av.data else [] 
+                df_rep = pd.DataFrame(v_rep["filas"]) if v_rep["filas"] else pd.DataFrame()
+                df_ent = pd.DataFrame(v_ent["filas"]) if v_ent["filas"] else pd.DataFrame()
+                list_av = datos.get("avisos") or [] 
                 
                 # Lógica de Riesgo
-                puntos = len(df_rep)
-                if puntos == 0: color_r, txt_r = "#00e676", "BAJO"
-                elif puntos <= 2: color_r, txt_r = "#ffeb3b", "MEDIO"
-                else: color_r, txt_r = "#ff5252", "ALTO"
+                color_r, txt_r = riesgo_alumno(inc["total"])
 
                 # --- 2. FUNCIÓN PDF CON SOPORTE PARA ACENTOS Y EMOJIS ---
                 def generar_pdf_seguro(datos_al, reporte_df, avisos, riesgo_txt):
@@ -1283,6 +1865,8 @@ elif menu == "Expediente Digital":
                 def gestionar_acceso(bloquear=True):
                     nuevo_estatus = not bloquear
                     supabase.table("alumnos").update({"estatus": nuevo_estatus}).eq("matricula", mat_exp).execute()
+                    # Los kioskos de este servidor ven el cambio en la siguiente lectura
+                    padron_alumnos().invalidar(mat_exp)
                     if bloquear:
                         # Quitamos el emoji del mensaje para evitar errores de PDF
                         supabase.table("avisos").insert({
@@ -1292,6 +1876,7 @@ elif menu == "Expediente Digital":
                         }).execute()
                     else:
                         supabase.table("avisos").update({"activo": False}).eq("matricula", mat_exp).execute()
+                    invalidar_consultas("alumnos", "avisos")
                     time.sleep(1)
                     st.rerun()
 
@@ -1310,7 +1895,18 @@ elif menu == "Expediente Digital":
                         if st.button("✅ ACTIVAR", use_container_width=True, type="primary"): gestionar_acceso(False)
 
                 # --- 5. BOTÓN PDF Y TABS ---
-                pdf_data = generar_pdf_seguro(al, df_rep, list_av, txt_r)
+                # El PDF lleva el historial completo; se lee solo si se descarga. Su
+                # llave usa lo que ya se leyó: el resumen de incidencias (total, último
+                # nivel y fecha) y el id más reciente de la primera ventana de reportes,
+                # que cambian con cada alta o baja. Si alguna de las dos consultas
+                # falló, la llave cambia en cada ejecución y el PDF no se reutiliza
+                if "incidencias" in errores or "reportes" in errores:
+                    ultimo_reporte = ["sin datos", time.time()]
+                else:
+                    ultimo_reporte = max((f["id"] for f in datos["reportes"][0]), default=None)
+                pdf_data = pdf_diferido("expediente", [al, inc, list_av, txt_r, ultimo_reporte],
+                                        lambda: generar_pdf_seguro(al, pd.DataFrame(
+                                            [f for pagina in leer_paginado("reportes", "*", [("eq", "matricula", mat_exp)]) for f in pagina]), list_av, txt_r))
                 st.download_button(
                     label="📥 Descargar Expediente (PDF)",
                     data=pdf_data,
@@ -1320,8 +1916,12 @@ elif menu == "Expediente Digital":
                 )
 
                 t1, t2 = st.tabs(["🕒 Asistencias", "🚨 Reportes"])
-                with t1: st.dataframe(df_ent, use_container_width=True)
-                with t2: st.dataframe(df_rep, use_container_width=True)
+                with t1:
+                    st.dataframe(df_ent, use_container_width=True)
+                    boton_cargar_mas(v_ent, "entradas", "*", mat_exp, "mas_entradas_expediente")
+                with t2:
+                    st.dataframe(df_rep, use_container_width=True)
+                    boton_cargar_mas(v_rep, "reportes", "*", mat_exp, "mas_reportes_expediente")
 
             else:
                 st.error("Matrícula no encontrada.")
@@ -0,0 +1,242 @@
+# ================= CREDENCIALES DE ALUMNO (85 x 55 mm) =================
+# Separado de control_acceso.py para que la impresión por grupo pueda repartir
+# el trabajo entre procesos: Streamlit ejecuta el script principal como código
+# suelto y los procesos hijos no pueden importar funciones definidas ahí.
+import hashlib
+import sys
+import threading
+import types
+import zlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from io import BytesIO
+
+import qrcode
+from fpdf import FPDF
+from PIL import Image
+
+ANCHO_CREDENCIAL, ALTO_CREDENCIAL = 85, 55
+# Hoja A4 con 2 columnas x 5 filas de credenciales y sus márgenes
+COLUMNAS_A4, FILAS_A4 = 2, 5
+MARGEN_X_A4 = (210 - COLUMNAS_A4 * ANCHO_CREDENCIAL) / 2
+MARGEN_Y_A4 = (297 - FILAS_A4 * ALTO_CREDENCIAL) / 2
+MIN_LOTE_PARALELO = 50  # por debajo de esto no vale la pena arrancar procesos
+MAX_QR_CACHE = 4096     # QR ya dibujados que se guardan por contenido (~1 KB c/u)
+
+_qr_cache = OrderedDict()
+_qr_lock = threading.Lock()
+_main_lock = threading.Lock()
+
+
+def _renderizar_qr(texto):
+    buf_qr = BytesIO()
+    qrcode.make(texto).save(buf_qr, format="PNG")
+    return buf_qr.getvalue()
+
+
+def _qr_en_cache(texto):
+    with _qr_lock:
+        img_q = _qr_cache.get(texto)
+        if img_q is not None:
+            _qr_cache.move_to_end(texto)
+        return img_q
+
+
+def _guardar_qr(texto, img_q):
+    with _qr_lock:
+        _qr_cache[texto] = img_q
+        _qr_cache.move_to_end(texto)
+        while len(_qr_cache) > MAX_QR_CACHE:
+            _qr_cache.popitem(last=False)
+
+
+def generar_qr_png(texto):
+    img_q = _qr_en_cache(texto)
+    if img_q is None:
+        img_q = _renderizar_qr(texto)
+        _guardar_qr(texto, img_q)
+    return img_q
+
+
+@lru_cache(maxsize=MAX_QR_CACHE)
+def _decodificar_png(datos):
+    # Datos de imagen en el formato que FPDF escribe al PDF (sin predictores PNG)
+    with Image.open(BytesIO(datos)) as img:
+        if img.mode == "1":
+            cs, bpc = "DeviceGray", 1
+        elif img.mode == "L":
+            cs, bpc = "DeviceGray", 8
+        else:
+            img = img.convert("RGB")
+            cs, bpc = "DeviceRGB", 8
+        return (("w", img.width), ("h", img.height), ("cs", cs), ("bpc", bpc),
+                ("f", "FlateDecode"), ("data", zlib.compress(img.tobytes())))
+
+
+class FPDFMemoria(FPDF):
+    # FPDF 1.7 arma el archivo con self.buffer += ..., que copia todo el PDF en
+    # cada línea (cuadrático: con cientos de páginas es casi todo el tiempo).
+    # Aquí el buffer es una lista de trozos con su largo acumulado y solo se
+    # une cuando FPDF lo lee completo (output() y un par de desplazamientos).
+    def __init__(self, *args, **kwargs):
+        self._trozos, self._largo = [], 0
+        super().__init__(*args, **kwargs)
+
+    @property
+    def buffer(self):
+        if len(self._trozos) > 1:
+            self._trozos = ["".join(self._trozos)]
+        return self._trozos[0] if self._trozos else ""
+
+    @buffer.setter
+    def buffer(self, valor):
+        self._trozos, self._largo = [valor], len(valor)
+
+    def _out(self, s):
+        if self.state == 2:
+            return super()._out(s)
+        if isinstance(s, bytes):
+            s = s.decode("latin1")
+        elif not isinstance(s, str):
+            s = str(s)
+        self._trozos.append(s + "\n")
+        self._largo += len(s) + 1
+
+    def _newobj(self):
+        # Igual que FPDF pero sin unir el buffer para saber su largo
+        self.n += 1
+        self.offsets[self.n] = self._largo
+        self._out(str(self.n) + ' 0 obj')
+
+    # FPDF 1.7 solo sabe leer imágenes desde un archivo. Aquí la imagen se
+    # registra ya decodificada, así que image() no toca el disco.
+    def imagen_png(self, datos, x=None, y=None, w=0, h=0):
+        nombre = f"memoria_{hashlib.sha1(datos).hexdigest()}.png"
+        if nombre not in self.images:
+            info = dict(_decodificar_png(datos))
+            info["i"] = len(self.images) + 1
+            self.images[nombre] = info
+        self.image(nombre, x=x, y=y, w=w, h=h)
+
+
+def dibujar_credencial(pdf, nom, grp, mat, img_q, x=0, y=0):
+    # Dibuja una credencial (pdf es un FPDFMemoria) con su esquina en (x, y)
+    # Fondo y Franjas
+    pdf.set_fill_color(22, 27, 34)
+    pdf.rect(x, y, 85, 55, 'F')
+    pdf.set_fill_color(30, 132, 73)
+    pdf.rect(x, y, 85, 4, 'F') # Superior
+    pdf.rect(x, y + 51, 85, 4, 'F') # Inferior
+
+    # Espacio para Foto
+    pdf.set_fill_color(40, 44, 52)
+    pdf.rect(x + 6, y + 10, 22, 28, 'F')
+    pdf.set_text_color(100, 100, 100)
+    pdf.set_font("Arial", 'B', 15)
+    pdf.set_xy(x + 6, y + 18)
+    pdf.cell(22, 10, "FOTO", 0, 0, 'C')
+
+    # --- GRUPO: INFERIOR IZQUIERDA (Debajo de la foto) ---
+    pdf.set_xy(x + 6, y + 42)
+    pdf.set_font("Arial", 'B', 11)
+    pdf.set_text_color(30, 132, 73)
+    pdf.cell(30, 5, f"{grp}", ln=False, align='L')
+
+    # Datos Institucionales y Nombre
+    pdf.set_text_color(255, 255, 255)
+    pdf.set_font("Arial", 'B', 8)
+    pdf.set_xy(x + 32, y + 8)
+    pdf.cell(0, 5, "CONALEP CUAUTLA")
+
+    pdf.set_xy(x + 32, y + 16)
+    pdf.set_font("Arial", 'B', 12)
+    nom_p = nom.encode('latin-1', 'replace').decode('latin-1').upper()
+    # Ancho de 48mm para que no choque con el QR
+    pdf.multi_cell(48, 6, nom_p, align='L')
+
+    # --- QR POSICIONADO A LA DERECHA (Sin reducir tamaño) ---
+    # x=58 permite que el QR de 22mm quepa perfecto sin tapar el texto
+    pdf.imagen_png(img_q, x=x + 58, y=y + 26, w=22)
+
+    # Borde de Corte
+    pdf.set_draw_color(60, 60, 60)
+    pdf.rect(x, y, 85, 55, 'D')
+
+
+def generar_pdf_alumno_final(nom, grp, mat, img_q):
+    pdf = FPDFMemoria(orientation='L', unit='mm', format=(ALTO_CREDENCIAL, ANCHO_CREDENCIAL))
+    pdf.set_auto_page_break(auto=False, margin=0)
+    pdf.add_page()
+    dibujar_credencial(pdf, nom, grp, mat, img_q)
+    return pdf.output(dest='S').encode('latin-1', 'ignore')
+
+
+@contextmanager
+def _main_sin_app():
+    # Streamlit pone en sys.modules["__main__"] un módulo con el __file__ de
+    # control_acceso.py, y 'spawn' haría que cada proceso hijo volviera a
+    # ejecutar la app al arrancar (BrokenProcessPool). Mientras se arrancan los
+    # procesos se deja un __main__ vacío, sin __file__ ni __spec__.
+    with _main_lock:
+        original = sys.modules.get("__main__")
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = original
+
+
+def qrs_en_paralelo(matriculas, al_avanzar=None):
+    qrs = {mat: _qr_en_cache(mat) for mat in matriculas}
+    faltan = [mat for mat, img_q in qrs.items() if img_q is None]
+    total, hechos = len(qrs), len(qrs) - len(faltan)
+
+    if len(faltan) < MIN_LOTE_PARALELO:
+        for mat in faltan:
+            qrs[mat] = generar_qr_png(mat)
+            hechos += 1
+            if al_avanzar: al_avanzar(hechos, total)
+    else:
+        # 'spawn' evita heredar los hilos de Streamlit en los procesos hijos
+        contexto = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(mp_context=contexto) as pool:
+            # map() manda todos los trozos de una vez, así que los procesos ya
+            # arrancaron cuando regresa y el avance se reporta con __main__ normal
+            with _main_sin_app():
+                resultados = pool.map(_renderizar_qr, faltan, chunksize=32)
+            for mat, img_q in zip(faltan, resultados):
+                qrs[mat] = img_q
+                _guardar_qr(mat, img_q)
+                hechos += 1
+                if al_avanzar and hechos % 32 == 0: al_avanzar(hechos, total)
+    if al_avanzar: al_avanzar(total, total)
+    return [qrs[mat] for mat in matriculas]
+
+
+def lote_credenciales(alumnos, hoja_a4=False, al_avanzar=None):
+    # alumnos: [{"matricula", "nombre", "grupo"}, ...] ya ordenados.
+    # Devuelve un solo PDF con una credencial por página o 10 por hoja A4.
+    qrs = qrs_en_paralelo([a["matricula"] for a in alumnos], al_avanzar)
+
+    if hoja_a4:
+        pdf = FPDFMemoria(orientation='P', unit='mm', format='A4')
+    else:
+        pdf = FPDFMemoria(orientation='L', unit='mm', format=(ALTO_CREDENCIAL, ANCHO_CREDENCIAL))
+    pdf.set_auto_page_break(auto=False, margin=0)
+
+    por_hoja = COLUMNAS_A4 * FILAS_A4 if hoja_a4 else 1
+    for i, (al, img_q) in enumerate(zip(alumnos, qrs)):
+        lugar = i % por_hoja
+        if lugar == 0:
+            pdf.add_page()
+        if hoja_a4:
+            x = MARGEN_X_A4 + (lugar % COLUMNAS_A4) * ANCHO_CREDENCIAL
+            y = MARGEN_Y_A4 + (lugar // COLUMNAS_A4) * ALTO_CREDENCIAL
+        else:
+            x = y = 0
+        dibujar_credencial(pdf, al.get("nombre") or "", al.get("grupo") or "", al["matricula"], img_q, x, y)
+
+    return pdf.output(dest='S').encode('latin-1', 'ignore')
@@ -0,0 +1,645 @@
+# ================= PRUEBA DE CARGA Y COMPROBACIONES DEL SERVICIO DE ESCANEO =================
+# Ejercita servicio_escaneo.py con las cachés reales sobre una base simulada en
+# memoria (no toca Supabase).
+#
+# Prueba de carga:
+#     python prueba_carga.py --puertas 8 --alumnos 1500 --latencia 0.05 --fallas 0.02
+# Comprobaciones de la sincronización de las cachés y de la cola local:
+#     python prueba_carga.py --comprobar
+import os
+import random
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from datetime import datetime, timezone
+from io import BytesIO
+
+import pytz
+from PIL import Image
+from postgrest.exceptions import APIError
+
+from credenciales import MIN_LOTE_PARALELO, _renderizar_qr, qrs_en_paralelo
+from servicio_escaneo import (
+    LOG_LATENCIAS, MARGEN_CURSOR, MAX_INTENTOS_COLA, MAX_INTENTOS_EVIDENCIAS, PREFIJO_FOTO_PENDIENTE,
+    AvisosActivos, ColaEntradas, ColaEvidencias, EntradasDelDia, EsperaCreciente, PadronAlumnos,
+    ServicioEscaneo,
+    configurar_log_latencias, _marca_menos,
+)
+
+ZONA = pytz.timezone("America/Mexico_City")
+
+
+# ================= PRUEBA DE CARGA (BASE SIMULADA) =================
+# Sustituto en memoria del cliente de Supabase con el contrato que usan las
+# clases de servicio_escaneo.py (table().select().eq()...execute(),
+# upsert/insert y rpc), para medir el servicio con las cachés reales y N
+# puertas leyendo a la vez.
+class _Respuesta:
+    def __init__(self, data):
+        self.data = data
+
+    def execute(self):
+        return self
+
+
+class _Consulta:
+    def __init__(self, base, tabla):
+        self.base = base
+        self.tabla = tabla
+        self._columnas = []
+        self._filtros = []
+        self._orden = []
+        self._limite = None
+        self._escritura = None
+        self._cambios = None
+
+    def _columna(self, columna):
+        # Como PostgREST: una columna que no existe es un error 42703
+        if columna not in self.base.columnas[self.tabla]:
+            raise APIError({"code": "42703", "message": f"column {self.tabla}.{columna} does not exist"})
+        return columna
+
+    def select(self, columnas):
+        self._columnas = [self._columna(c.strip()) for c in columnas.split(",")]
+        return self
+
+    def _filtro(self, columna, prueba):
+        self._columna(columna)
+        self._filtros.append(lambda fila: fila.get(columna) is not None and prueba(fila[columna]))
+        return self
+
+    def eq(self, columna, valor):
+        return self._filtro(columna, lambda v: v == valor)
+
+    def gt(self, columna, valor):
+        return self._filtro(columna, lambda v: v > valor)
+
+    def gte(self, columna, valor):
+        return self._filtro(columna, lambda v: v >= valor)
+
+    def in_(self, columna, valores):
+        return self._filtro(columna, lambda v: v in valores)
+
+    def order(self, columna, desc=False):
+        self._orden.append((self._columna(columna), desc))
+        return self
+
+    def limit(self, n):
+        self._limite = n
+        return self
+
+    def upsert(self, filas, on_conflict=None, ignore_duplicates=False, returning=None):
+        self._escritura = (filas, ignore_duplicates)
+        return self
+
+    def insert(self, filas, returning=None):
+        self._escritura = (filas, None)
+        return self
+
+    def update(self, valores):
+        self._cambios = {self._columna(c): v for c, v in valores.items()}
+        return self
+
+    def execute(self):
+        time.sleep(self.base.latencia)
+        if self.base.caida:
+            raise ConnectionError("la base no respondió (simulado)")
+        with self.base._lock:
+            self.base.consultas += 1
+            if self._escritura is not None:
+                self.base.escribir(self.tabla, *self._escritura)
+                return _Respuesta([])
+            if self._cambios is not None:
+                filas = [f for f in self.base.tablas[self.tabla] if all(p(f) for p in self._filtros)]
+                for fila in filas:
+                    fila.update(self._cambios)
+                return _Respuesta([dict(f) for f in filas])
+            filas = [dict(f) for f in self.base.tablas[self.tabla] if all(p(f) for p in self._filtros)]
+        for columna, desc in reversed(self._orden):
+            filas.sort(key=lambda f: f[columna], reverse=desc)
+        if self._limite is not None:
+            filas = filas[:self._limite]
+        return _Respuesta([{c: f.get(c) for c in self._columnas} for f in filas])
+
+
+class _AlmacenSimulado:
+    # La cubeta 'evidencias' de Storage: upload, get_public_url y download
+    def __init__(self, base):
+        self.base = base
+        self.archivos = {}
+
+    def from_(self, cubeta):
+        return self
+
+    def upload(self, nombre, datos, opciones=None):
+        if self.base.caida:
+            raise ConnectionError("Storage no respondió (simulado)")
+        self.archivos[nombre] = datos
+
+    def get_public_url(self, nombre):
+        return f"https://simulado.supabase.co/storage/v1/object/public/evidencias/{nombre}"
+
+    def download(self, nombre):
+        if self.base.caida:
+            raise ConnectionError("Storage no respondió (simulado)")
+        return self.archivos[nombre]
+
+
+class _BaseSimulada:
+    # Tablas con sus columnas y su llave única (sql/003 para entradas),
+    # registrar_escaneo como en sql/011 y la latencia de red indicada en cada
+    # llamada. 'fallas' es la fracción de llamadas a registrar_escaneo que no
+    # responden, para que también trabaje la cola local.
+    UNICAS = {"alumnos": ("matricula",), "avisos": ("id",), "entradas": ("matricula", "fecha"), "reportes": ("id",)}
+    COLUMNAS = {
+        "alumnos": {"matricula", "nombre", "grupo", "estatus", "updated_at"},
+        "avisos": {"id", "matricula", "mensaje", "prioridad", "activo", "updated_at"},
+        "entradas": {"id", "fecha", "hora", "matricula", "nombre", "grupo", "registro_por"},
+        "reportes": {"id", "matricula", "foto_url", "miniatura_url"},
+    }
+
+    def __init__(self, latencia=0.0, fallas=0.0, semilla=11):
+        self.latencia = latencia
+        self.fallas = fallas
+        self.columnas = {tabla: set(columnas) for tabla, columnas in self.COLUMNAS.items()}
+        self.tablas = {tabla: [] for tabla in self.UNICAS}
+        self.caida = False  # True: ninguna llamada responde
+        self.sin_011 = False  # True: registrar_escaneo sin p_con_aviso (sql/002)
+        self.storage = _AlmacenSimulado(self)
+        self.llamadas = 0   # registrar_escaneo
+        self.consultas = 0  # table(...).execute()
+        self._indices = {tabla: {} for tabla in self.UNICAS}
+        self._azar = random.Random(semilla)
+        self._lock = threading.Lock()
+
+    def table(self, nombre):
+        return _Consulta(self, nombre)
+
+    def escribir(self, tabla, filas, ignorar=None, marca=None):
+        # ignorar=None es un insert (un duplicado rechaza todo el lote);
+        # True/False es upsert que ignora o actualiza los duplicados.
+        # marca fija 'updated_at', p. ej. para una transacción que confirmó tarde
+        unica, indice = self.UNICAS[tabla], self._indices[tabla]
+        for fila in filas:
+            for columna in fila:
+                if columna not in self.columnas[tabla]:
+                    raise APIError({"code": "PGRST204", "message": f"Could not find the '{columna}' column of '{tabla}'"})
+        if ignorar is None and any(tuple(f[c] for c in unica) in indice for f in filas):
+            raise APIError({"code": "23505", "message": f"duplicate key value violates unique constraint on {tabla}"})
+        for fila in filas:
+            clave = tuple(fila[c] for c in unica)
+            actual = indice.get(clave)
+            if actual is not None and ignorar:
+                continue
+            if actual is None:
+                actual = indice[clave] = {"id": len(self.tablas[tabla]) + 1}
+                self.tablas[tabla].append(actual)
+            actual.update(fila)
+            if "updated_at" in self.columnas[tabla]:
+                actual["updated_at"] = marca or datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+    def rpc(self, nombre, params):
+        time.sleep(self.latencia)
+        with self._lock:
+            self.llamadas += 1
+            if self.caida or self._azar.random() < self.fallas:
+                raise ConnectionError("la base no respondió (simulado)")
+            if self.sin_011 and "p_con_aviso" in params:
+                raise APIError({"code": "PGRST202", "message": "Could not find the function registrar_escaneo"})
+            mat = params["p_matricula"]
+            al = self._indices["alumnos"].get((mat,))
+            if not al:
+                return _Respuesta({"encontrado": False})
+            r = {"encontrado": True, "nombre": al["nombre"], "grupo": al["grupo"], "estatus": al["estatus"]}
+            if al["estatus"] is False:
+                return _Respuesta(r)
+            r["ya_registrada"] = (mat, params["p_fecha"]) in self._indices["entradas"]
+            if not r["ya_registrada"]:
+                self.escribir("entradas", [{"fecha": params["p_fecha"], "hora": params["p_hora"], "matricula": mat,
+                                            "nombre": al["nombre"], "grupo": al["grupo"],
+                                            "registro_por": params["p_registro_por"]}])
+            avisos = [a for a in self.tablas["avisos"] if a["matricula"] == mat and a["activo"]
+                      and params.get("p_con_aviso", True)]
+            if avisos:
+                ultimo = max(avisos, key=lambda a: a["id"])
+                r["aviso"] = {"mensaje": ultimo["mensaje"], "prioridad": ultimo["prioridad"]}
+        return _Respuesta(r)
+
+
+def prueba_de_carga(puertas=8, alumnos=1500, repetidos=0.1, latencia=0.05, precalentado=0.8, fallas=0.02):
+    # Simula la hora de entrada: 'alumnos' credenciales repartidas entre las
+    # puertas, una fracción leída dos veces en puertas distintas casi a la vez,
+    # y el padrón en memoria con solo 'precalentado' de los alumnos. Usa las
+    # mismas clases que el servidor, cada una con su hilo de refresco.
+    from queue import Queue, Empty
+
+    rnd = random.Random(7)
+    zona = ZONA
+    base = _BaseSimulada(latencia, fallas)
+    matriculas = [f"A{i:05d}" for i in range(alumnos)]
+    base.escribir("alumnos", [{"matricula": mat, "nombre": f"ALUMNO {i}", "grupo": "1A", "estatus": i % 50 != 0}
+                              for i, mat in enumerate(matriculas)])
+    base.escribir("avisos", [{"id": n + 1, "matricula": mat, "mensaje": "PASAR A ORIENTACIÓN", "prioridad": "ALTA",
+                              "activo": True} for n, mat in enumerate(matriculas[::97])])
+
+    padron = PadronAlumnos(base)
+    entradas = EntradasDelDia(base, zona)
+    avisos = AvisosActivos(base)
+    cola = ColaEntradas(base, ruta=":memory:")
+    for cache in (padron, entradas, avisos):
+        cache.asegurar_carga()
+    for mat in matriculas:
+        if rnd.random() >= precalentado:
+            padron.invalidar(mat)
+    servicio = ServicioEscaneo(base, padron, entradas, avisos, cola, zona)
+
+    lecturas = list(matriculas) + ["NO-EXISTE-%d" % i for i in range(alumnos // 100)]
+    lecturas += rnd.sample(matriculas, int(alumnos * repetidos))
+    rnd.shuffle(lecturas)
+    fila = Queue()
+    for mat in lecturas:
+        fila.put(mat)
+
+    tiempos, excepciones, lock_tiempos = [], Counter(), threading.Lock()
+
+    def puerta(n):
+        while True:
+            try:
+                mat = fila.get_nowait()
+            except Empty:
+                return
+            t0 = time.perf_counter()
+            try:
+                servicio.escanear(mat.lower(), f"puerta-{n}")
+            except Exception as e:
+                # Sin base y sin el alumno en memoria: el kiosko muestra el error
+                with lock_tiempos:
+                    excepciones[type(e).__name__] += 1
+            with lock_tiempos:
+                tiempos.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    hilos = [threading.Thread(target=puerta, args=(n,)) for n in range(puertas)]
+    for h in hilos: h.start()
+    for h in hilos: h.join()
+    total = time.perf_counter() - t0
+    while cola.pendientes():
+        cola.vaciar_lote()
+
+    tiempos.sort()
+    guardadas = len(base.tablas["entradas"])
+    est = padron.estadisticas()
+    print(f"{puertas} puertas · {len(lecturas)} lecturas en {total:.2f} s "
+          f"({len(lecturas) / total:.0f} lecturas/s)")
+    print(f"latencia p50 {1000 * tiempos[len(tiempos) // 2]:.1f} ms · "
+          f"p95 {1000 * tiempos[int(len(tiempos) * 0.95)]:.1f} ms · "
+          f"p99 {1000 * tiempos[int(len(tiempos) * 0.99)]:.1f} ms")
+    for fila in servicio.latencias.resumen():
+        print(f"  {fila['etapa']:<14} n={fila['n']:<6} p50 {fila['p50']:>8.2f} ms · "
+              f"p95 {fila['p95']:>8.2f} ms · p99 {fila['p99']:>8.2f} ms")
+    print(f"resultados: {dict(servicio.metricas)} · sin salida: {dict(excepciones)}")
+    print(f"padrón: {est['tasa_aciertos']}% aciertos · cola local: {cola.metricas['encoladas']} encoladas, "
+          f"{cola.metricas['enviadas']} enviadas · cortes de red: {servicio.cortes_red}")
+    print(f"llamadas a registrar_escaneo: {base.llamadas} · consultas: {base.consultas} · "
+          f"entradas guardadas: {guardadas}")
+    # Cada "ok" es exactamente una entrada en la base, ya sea directa o por la cola
+    return (servicio.metricas["ok"] == guardadas
+            and servicio.metricas["lecturas"] + sum(excepciones.values()) == len(lecturas))
+
+
+# ================= COMPROBACIONES DE SINCRONIZACIÓN =================
+# Cada comprobación arma su propia _BaseSimulada y falla con AssertionError:
+# avisos y padrón por el cursor (también lo que confirmó tarde), una base sin
+# 'updated_at' (42703) en relectura completa, una caída de red que no apaga el
+# modo incremental y una entrada rechazada que no detiene la cola local.
+def _aviso(id_aviso, mat, mensaje, activo=True):
+    return {"id": id_aviso, "matricula": mat, "mensaje": mensaje, "prioridad": "ALTA", "activo": activo}
+
+
+def _alumno(mat, estatus=True):
+    return {"matricula": mat, "nombre": f"ALUMNO {mat}", "grupo": "1A", "estatus": estatus}
+
+
+def _entrada(mat, **extra):
+    return {"fecha": "2024-01-08", "hora": "07:00:00", "matricula": mat, "nombre": f"ALUMNO {mat}",
+            "grupo": "1A", "registro_por": "puerta-1", **extra}
+
+
+def comprobar_avisos_por_cursor():
+    base = _BaseSimulada()
+    base.escribir("avisos", [_aviso(1, "A1", "uno"), _aviso(2, "A2", "dos", activo=False)])
+    avisos = AvisosActivos(base)
+    avisos.cargar()
+    assert avisos.obtener("A1") == {"mensaje": "uno", "prioridad": "ALTA"}, avisos.obtener("A1")
+    assert avisos.obtener("A2") is None, "un aviso inactivo no se carga"
+    base.escribir("avisos", [_aviso(3, "A1", "tres"), _aviso(2, "A2", "dos")], ignorar=False)
+    avisos.refrescar()
+    assert avisos.obtener("A1")["mensaje"] == "tres", "el refresco no trajo el aviso nuevo"
+    assert avisos.obtener("A2")["mensaje"] == "dos", "el refresco no trajo el aviso reactivado"
+    base.escribir("avisos", [_aviso(3, "A1", "tres", activo=False)], ignorar=False)
+    avisos.refrescar()
+    assert avisos.obtener("A1")["mensaje"] == "uno", "un aviso retirado debe dejar ver el anterior"
+
+
+def comprobar_avisos_sin_red():
+    base = _BaseSimulada()
+    base.caida = True
+    avisos = AvisosActivos(base)
+    try:
+        avisos.cargar()
+    except ConnectionError:
+        pass
+    else:
+        raise AssertionError("una caída de red al cargar los avisos debe propagarse")
+    assert avisos._incremental, "una caída de red no debe apagar el modo incremental"
+
+
+def comprobar_avisos_sin_updated_at():
+    base = _BaseSimulada()
+    base.columnas["avisos"].discard("updated_at")
+    base.escribir("avisos", [_aviso(1, "A1", "uno")])
+    avisos = AvisosActivos(base)
+    avisos.cargar()
+    base.escribir("avisos", [_aviso(1, "A1", "uno", activo=False)], ignorar=False)
+    avisos.refrescar()
+    assert not avisos._incremental, "sin 'updated_at' debe pasar a relectura completa"
+    assert avisos.obtener("A1") is None, "la relectura completa no quitó el aviso retirado"
+
+
+def comprobar_padron_por_cursor():
+    base = _BaseSimulada()
+    base.escribir("alumnos", [_alumno("A1"), _alumno("A2")])
+    padron = PadronAlumnos(base)
+    padron.cargar()
+    base.escribir("alumnos", [_alumno("A1", estatus=False)], ignorar=False)
+    padron.refrescar()
+    assert padron.obtener("A1")["estatus"] is False, "el bloqueo no llegó con el refresco"
+    # Una fila que confirmó tarde (updated_at anterior al cursor) entra por el margen
+    tarde = _marca_menos(padron._cursor, MARGEN_CURSOR / 2)
+    base.escribir("alumnos", [_alumno("A2", estatus=False)], ignorar=False, marca=tarde)
+    padron.refrescar()
+    assert padron.obtener("A2")["estatus"] is False, "el margen del cursor no alcanzó la fila tardía"
+
+
+def comprobar_padron_recarga_completa():
+    base = _BaseSimulada()
+    base.escribir("alumnos", [_alumno("A1")])
+    padron = PadronAlumnos(base, intervalo=0.01, recarga=0.05)
+    padron.asegurar_carga()
+    muy_tarde = _marca_menos(padron._cursor, MARGEN_CURSOR * 4)
+    base.escribir("alumnos", [_alumno("A1", estatus=False)], ignorar=False, marca=muy_tarde)
+    time.sleep(0.3)
+    assert padron.metricas["recargas"] > 0, "no hubo recarga completa"
+    assert padron.obtener("A1")["estatus"] is False, "la recarga completa no corrigió lo que el margen no alcanza"
+
+
+def comprobar_padron_sin_red():
+    base = _BaseSimulada()
+    base.caida = True
+    padron = PadronAlumnos(base)
+    try:
+        padron.cargar()
+    except ConnectionError:
+        pass
+    else:
+        raise AssertionError("una caída de red al cargar el padrón debe propagarse")
+    assert padron._incremental, "una caída de red no debe apagar el modo incremental"
+
+
+def comprobar_padron_sin_updated_at():
+    base = _BaseSimulada()
+    base.columnas["alumnos"].discard("updated_at")
+    base.escribir("alumnos", [_alumno("A1")])
+    padron = PadronAlumnos(base)
+    padron.cargar()
+    assert not padron._incremental, "sin 'updated_at' el padrón debe quedar solo con TTL"
+    assert padron.obtener("A1") is not None, "la carga completa sin 'updated_at' no trajo al alumno"
+
+
+def comprobar_cola_con_rechazadas():
+    base = _BaseSimulada()
+    cola = ColaEntradas(base, ruta=":memory:")
+    cola.encolar(_entrada("A0", columna_que_no_existe=1))
+    for mat in ("A1", "A2"):
+        cola.encolar(_entrada(mat))
+    cola.vaciar_lote()
+    assert len(base.tablas["entradas"]) == 2, "una entrada rechazada detuvo a las demás"
+    assert cola.pendientes() == 1, cola.pendientes()
+    cola.encolar(_entrada("A3"))
+    cola.vaciar_lote()
+    assert len(base.tablas["entradas"]) == 3, "la rechazada debe pasar al final de la cola"
+    for _ in range(MAX_INTENTOS_COLA):
+        try:
+            cola.vaciar_lote()
+        except RuntimeError:
+            pass
+    assert cola.pendientes() == 0, f"tras {MAX_INTENTOS_COLA} rechazos la entrada sigue pendiente"
+    assert cola.rechazadas() == 1, cola.rechazadas()
+
+
+class _ColaEvidenciasSinHilo(ColaEvidencias):
+    # La comprobación llama a subir_siguiente() a mano
+    def _ciclo(self):
+        pass
+
+
+def _jpeg():
+    buf = BytesIO()
+    Image.new("RGB", (64, 48), "white").save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def comprobar_cola_de_evidencias():
+    base = _BaseSimulada()
+    base.escribir("reportes", [{"id": 1, "matricula": "A1", "foto_url": PREFIJO_FOTO_PENDIENTE + "r1.jpg"}])
+    cola = _ColaEvidenciasSinHilo(base, ruta=":memory:")
+    cola.encolar("r1.jpg", _jpeg())
+    base.caida = True
+    for _ in range(MAX_INTENTOS_EVIDENCIAS + 1):
+        try:
+            cola.subir_siguiente()
+        except ConnectionError:
+            pass
+    assert cola.pendientes() == 1 and cola.rechazadas() == 0, "sin red la foto espera sin gastar intentos"
+    base.caida = False
+    assert cola.subir_siguiente(), "con red la foto debe subir"
+    reporte = base.tablas["reportes"][0]
+    assert reporte["foto_url"].endswith("/evidencias/r1.jpg"), reporte
+    assert reporte["miniatura_url"].endswith("/evidencias/miniaturas/r1.jpg"), reporte
+    assert cola.pendientes() == 0, cola.pendientes()
+    # La foto se encola antes que su reporte: mientras no exista, no se da por subida
+    cola.encolar("r3.jpg", _jpeg())
+    try:
+        cola.subir_siguiente()
+    except RuntimeError:
+        pass
+    assert cola.pendientes() == 1, "una foto sin reporte no debe darse por subida"
+    base.escribir("reportes", [{"id": 3, "matricula": "A1", "foto_url": PREFIJO_FOTO_PENDIENTE + "r3.jpg"}])
+    assert cola.subir_siguiente() and cola.pendientes() == 0, "con el reporte guardado la foto debe subir"
+    # Si el reporte no se pudo guardar, la foto se descarta del diario
+    cola.encolar("r4.jpg", _jpeg())
+    cola.descartar("r4.jpg")
+    assert cola.pendientes() == 0, "descartar no quitó la foto"
+    cola.encolar("r2.jpg", b"no es un JPEG")
+    for _ in range(MAX_INTENTOS_EVIDENCIAS):
+        try:
+            cola.subir_siguiente()
+        except Exception:
+            pass
+    assert cola.pendientes() == 0, f"tras {MAX_INTENTOS_EVIDENCIAS} rechazos la foto sigue pendiente"
+    assert cola.rechazadas() == 1, cola.rechazadas()
+
+
+def _servicio(base, **opciones):
+    padron = PadronAlumnos(base)
+    padron.cargar()
+    return ServicioEscaneo(base, padron, EntradasDelDia(base, ZONA), AvisosActivos(base),
+                           ColaEntradas(base, ruta=":memory:"), ZONA, **opciones)
+
+
+def comprobar_aviso_desde_memoria():
+    base = _BaseSimulada()
+    base.escribir("alumnos", [_alumno("A1"), _alumno("A2"), _alumno("A3")])
+    base.escribir("avisos", [_aviso(1, "A1", "uno"), _aviso(2, "A2", "dos"), _aviso(3, "A3", "tres")])
+    llamadas, rpc = [], base.rpc
+    base.rpc = lambda nombre, params: llamadas.append(params) or rpc(nombre, params)
+    servicio = _servicio(base)
+    assert servicio.escanear("A1")["aviso"]["mensaje"] == "uno", "sin avisos en memoria el aviso viene de la base"
+    assert "p_con_aviso" not in llamadas[-1], llamadas[-1]
+    servicio.avisos.asegurar_carga()
+    assert servicio.escanear("A2")["aviso"]["mensaje"] == "dos", "con avisos en memoria el aviso sale de ahí"
+    assert llamadas[-1].get("p_con_aviso") is False, "con avisos en memoria la base no debe buscarlos"
+    base.sin_011 = True
+    assert servicio.escanear("A3")["aviso"]["mensaje"] == "tres"
+    assert "p_con_aviso" not in llamadas[-1], "una base sin sql/011 debe recibir la llamada de siempre"
+
+
+def comprobar_corte_de_red():
+    base = _BaseSimulada()
+    base.escribir("alumnos", [_alumno("A1"), _alumno("A2"), _alumno("A3")])
+    servicio = _servicio(base, pausa_sin_red=5, intervalo_sondeo=0.05)
+    base.caida = True
+    assert servicio.escanear("A1")["tipo"] == "ok", "sin red se admite con el padrón"
+    assert servicio.sin_red() and base.llamadas == 1, base.llamadas
+    assert servicio.escanear("A2")["tipo"] == "ok"
+    assert base.llamadas == 1, "con el paso cortado no debe esperar a registrar_escaneo"
+    assert servicio.cola.pendientes() == 2, servicio.cola.pendientes()
+    base.caida = False
+    time.sleep(0.3)
+    assert not servicio.sin_red(), "el sondeo no reabrió el paso al volver la base"
+    assert servicio.escanear("A3")["tipo"] == "ok" and base.llamadas == 2, base.llamadas
+
+
+def comprobar_error_de_la_base_no_encola():
+    def rechazar(nombre, params):
+        raise APIError({"code": "P0001", "message": "registrar_escaneo rechazó la lectura (simulado)"})
+
+    base = _BaseSimulada()
+    base.escribir("alumnos", [_alumno("A1")])
+    base.rpc = rechazar
+    servicio = _servicio(base)
+    try:
+        servicio.escanear("A1")
+    except APIError:
+        pass
+    else:
+        raise AssertionError("un error de la base debe llegar al kiosko")
+    assert servicio.cola.pendientes() == 0, "un error de la base no es falta de red"
+    assert not servicio.sin_red(), "un error de la base no corta el paso"
+
+
+def comprobar_carga_inicial_con_espera():
+    base = _BaseSimulada()
+    base.escribir("alumnos", [_alumno("A1")])
+    base.caida = True
+    padron = PadronAlumnos(base)
+    padron._espera_carga = EsperaCreciente(0.1)
+    try:
+        padron.asegurar_carga()
+    except ConnectionError:
+        pass
+    else:
+        raise AssertionError("la primera carga sin red debe fallar")
+    base.caida = False
+    try:
+        padron.asegurar_carga()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("durante la espera no debe volver a intentar")
+    assert not padron.cargado and padron._espera_carga.espera == 0.2, padron._espera_carga.espera
+    time.sleep(0.15)
+    padron.asegurar_carga()
+    assert padron.cargado and padron.obtener("A1") is not None, "pasada la espera la carga debe funcionar"
+
+
+def comprobar_qrs_en_paralelo_bajo_streamlit():
+    # Streamlit deja en __main__ un módulo con el __file__ de la app: los
+    # procesos 'spawn' de qrs_en_paralelo no deben volver a ejecutarla
+    app = types.ModuleType("__main__")
+    app.__file__ = os.path.join(os.path.dirname(os.path.abspath(__file__)), "control_acceso.py")
+    matriculas = [f"QR{os.getpid()}-{i:04d}" for i in range(MIN_LOTE_PARALELO + 10)]
+    original = sys.modules["__main__"]
+    sys.modules["__main__"] = app
+    try:
+        qrs = qrs_en_paralelo(matriculas)
+        assert sys.modules["__main__"] is app, "qrs_en_paralelo no restauró __main__"
+    finally:
+        sys.modules["__main__"] = original
+    assert len(qrs) == len(matriculas), len(qrs)
+    assert qrs[0] == _renderizar_qr(matriculas[0]) and qrs[-1] == _renderizar_qr(matriculas[-1]), \
+        "los QR de los procesos no coinciden con los dibujados aquí"
+
+
+COMPROBACIONES = [
+    comprobar_avisos_por_cursor,
+    comprobar_avisos_sin_red,
+    comprobar_avisos_sin_updated_at,
+    comprobar_padron_por_cursor,
+    comprobar_padron_recarga_completa,
+    comprobar_padron_sin_red,
+    comprobar_padron_sin_updated_at,
+    comprobar_cola_con_rechazadas,
+    comprobar_cola_de_evidencias,
+    comprobar_aviso_desde_memoria,
+    comprobar_corte_de_red,
+    comprobar_error_de_la_base_no_encola,
+    comprobar_carga_inicial_con_espera,
+    comprobar_qrs_en_paralelo_bajo_streamlit,
+]
+
+
+def comprobar():
+    fallas = 0
+    for comprobacion in COMPROBACIONES:
+        try:
+            comprobacion()
+            print(f"ok    {comprobacion.__name__}")
+        except Exception as e:
+            fallas += 1
+            print(f"FALLA {comprobacion.__name__}: {type(e).__name__}: {e}")
+    return fallas == 0
+
+
+if __name__ == "__main__":
+    import argparse
+
+    if not __debug__:
+        raise SystemExit("las comprobaciones usan assert: ejecutar sin -O")
+    parser = argparse.ArgumentParser(description="Prueba de carga del servicio de escaneo")
+    parser.add_argument("--comprobar", action="store_true", help="solo revisa la sincronización de las cachés")
+    parser.add_argument("--puertas", type=int, default=8)
+    parser.add_argument("--alumnos", type=int, default=1500)
+    parser.add_argument("--repetidos", type=float, default=0.1)
+    parser.add_argument("--latencia", type=float, default=0.05, help="segundos por llamada a la base")
+    parser.add_argument("--precalentado", type=float, default=0.8, help="fracción del padrón ya en memoria")
+    parser.add_argument("--fallas", type=float, default=0.02, help="fracción de registrar_escaneo sin respuesta")
+    args = parser.parse_args()
+    # Las trazas se escriben igual (cuenta en la medición) pero no llenan la consola
+    configurar_log_latencias(LOG_LATENCIAS or os.devnull)
+    if args.comprobar:
+        raise SystemExit(0 if comprobar() else 1)
+    raise SystemExit(0 if prueba_de_carga(args.puertas, args.alumnos, args.repetidos,
+                                          args.latencia, args.precalentado, args.fallas) else 1)
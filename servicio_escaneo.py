@@ -0,0 +1,1148 @@
+# ================= SERVICIO DE ESCANEO (PUERTA DE ENTRADA) =================
+# La lógica de una lectura de credencial, separada de la interfaz de Streamlit.
+# Hay una sola instancia por servidor (st.cache_resource en control_acceso.py):
+# todos los kioskos comparten el padrón, las entradas del día, los avisos, la
+# cola local y la conexión, y cada lectura puede llegar desde cualquier hilo.
+# Esas cachés también viven aquí y reciben el cliente al construirse, igual que
+# la cola de evidencias de Reportes, que comparte con la cola de entradas el
+# diario local en SQLite. La prueba de carga y las comprobaciones sobre una base
+# simulada están en prueba_carga.py.
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import httpx
+from PIL import Image, ImageOps
+from postgrest.exceptions import APIError
+
+MAX_MUESTRAS_LATENCIA = 5000  # por etapa; los percentiles salen de las más recientes
+MAX_TRAZAS = 1000             # lecturas completas que se guardan para exportar
+
+# Una traza JSON por lectura. SICA_LOG_LATENCIAS elige el destino: vacío es
+# stderr (el log del servidor), "0" las apaga y cualquier otro valor es la ruta
+# de un archivo.
+LOG_LATENCIAS = os.environ.get("SICA_LOG_LATENCIAS", "")
+
+log_latencias = logging.getLogger("sica.latencias")
+
+
+def configurar_log_latencias(destino=LOG_LATENCIAS):
+    if log_latencias.handlers:
+        return  # ya configurado (Streamlit vuelve a ejecutar el script)
+    if destino == "0":
+        log_latencias.setLevel(logging.WARNING)
+        return
+    manejador = logging.FileHandler(destino, encoding="utf-8") if destino else logging.StreamHandler()
+    manejador.setFormatter(logging.Formatter("%(message)s"))
+    log_latencias.addHandler(manejador)
+    log_latencias.setLevel(logging.INFO)
+    log_latencias.propagate = False
+
+
+def normalizar_matricula(mat):
+    if not mat: return ""
+    return mat.strip().upper().replace('"', '-').replace("'", '-')
+
+
+def registrar_escaneo(cliente, mat, registro_por, ahora, con_aviso=True):
+    # Un solo viaje a la base (sql/002_registrar_escaneo.sql): resuelve al alumno,
+    # su aviso activo y si ya entró hoy, y registra la entrada si procede.
+    # con_aviso=False se salta la búsqueda del aviso (sql/011).
+    params = {
+        "p_matricula": mat,
+        "p_fecha": ahora.strftime("%Y-%m-%d"),
+        "p_hora": ahora.strftime("%H:%M:%S"),
+        "p_registro_por": registro_por
+    }
+    if not con_aviso:
+        params["p_con_aviso"] = False
+    return cliente.rpc("registrar_escaneo", params).execute().data
+
+
+def falla_de_red(error):
+    # La base no contestó (sin conexión o tiempo agotado); un APIError sí es
+    # una respuesta y no se confunde con una caída
+    return isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+# ================= LECTURA Y ENVÍO CON UN CLIENTE =================
+# Las mismas rutinas que usa control_acceso.py, pero con el cliente como primer
+# argumento para que las cachés de este módulo no dependan de Streamlit.
+TAM_PAGINA = 1000  # límite de filas por respuesta de Supabase
+TAM_LOTE_ENVIO = 500
+REINTENTOS_ENVIO = 3
+
+
+def _en_trozos(registros, tam):
+    trozo = []
+    for registro in registros:
+        trozo.append(registro)
+        if len(trozo) == tam:
+            yield trozo
+            trozo = []
+    if trozo:
+        yield trozo
+
+
+def _insertar_filas(cliente, tabla, filas, on_conflict=None, fusionar=False):
+    if on_conflict:
+        return cliente.table(tabla).upsert(filas, on_conflict=on_conflict,
+                                           ignore_duplicates=not fusionar, returning="minimal").execute()
+    return cliente.table(tabla).insert(filas, returning="minimal").execute()
+
+
+def enviar_lote(cliente, tabla, registros, tam_lote=TAM_LOTE_ENVIO, reintentos=REINTENTOS_ENVIO, on_conflict=None,
+                fusionar=False):
+    # Como enviar() de control_acceso.py, pero acepta una lista o un generador
+    # y manda varias filas por llamada. Devuelve (enviados, fallidos) con fallidos = [(registro, error), ...]
+    # Con on_conflict las filas repetidas se ignoran, o se actualizan si fusionar=True.
+    enviados, fallidos = 0, []
+    for trozo in _en_trozos(registros, tam_lote):
+        filas = [{k.lower(): v for k, v in r.items()} for r in trozo]
+        for intento in range(reintentos + 1):
+            try:
+                _insertar_filas(cliente, tabla, filas, on_conflict, fusionar)
+                enviados += len(filas)
+                break
+            except APIError:
+                # La base rechazó el lote: fila por fila para aislar las que fallan
+                for registro, fila in zip(trozo, filas):
+                    try:
+                        _insertar_filas(cliente, tabla, [fila], on_conflict, fusionar)
+                        enviados += 1
+                    except Exception as e:
+                        fallidos.append((registro, str(e)))
+                break
+            except Exception as e:
+                # Falla de red: se reintenta el lote completo
+                if intento == reintentos:
+                    fallidos.extend((registro, str(e)) for registro in trozo)
+                else:
+                    time.sleep(2 ** intento)
+    return enviados, fallidos
+
+
+def leer_paginado(cliente, tabla, columnas, filtros=(), clave="id", tam_pagina=TAM_PAGINA):
+    # Recorre una tabla por páginas con paginación por llave (keyset) y entrega
+    # cada página como lista, trayendo solo las columnas pedidas.
+    # filtros: [(operador, columna, valor)], p. ej. [("eq", "matricula", mat)]
+    # clave: columna única, o ("fecha", "id") para avanzar por fecha con desempate
+    if isinstance(columnas, str):
+        columnas = [c.strip() for c in columnas.split(",")]
+    claves = (clave,) if isinstance(clave, str) else tuple(clave)
+    seleccion = ", ".join(dict.fromkeys([*columnas, *claves]))
+    ultimo = None
+    while True:
+        q = cliente.table(tabla).select(seleccion)
+        for operador, columna, valor in filtros:
+            q = getattr(q, operador)(columna, valor)
+        if ultimo is not None:
+            if len(claves) == 1:
+                q = q.gt(claves[0], ultimo[0])
+            else:
+                c1, c2 = claves
+                q = q.or_(f"{c1}.gt.{ultimo[0]},and({c1}.eq.{ultimo[0]},{c2}.gt.{ultimo[1]})")
+        for c in claves:
+            q = q.order(c)
+        pagina = q.limit(tam_pagina).execute().data or []
+        if pagina:
+            yield pagina
+        if len(pagina) < tam_pagina:
+            return
+        ultimo = tuple(pagina[-1][c] for c in claves)
+
+
+# ================= LATENCIAS POR ETAPA =================
+# Tiempos en ms de cada etapa de una lectura (y de cualquier otra operación que
+# se mida con medir()). Cada lectura deja además una traza que se escribe como
+# JSON en el logger 'sica.latencias' y se puede descargar desde el panel.
+class Latencias:
+    def __init__(self, max_muestras=MAX_MUESTRAS_LATENCIA, max_trazas=MAX_TRAZAS):
+        self.max_muestras = max_muestras
+        self._lock = threading.Lock()
+        self._etapas = {}  # etapa -> deque de ms
+        self._trazas = deque(maxlen=max_trazas)
+
+    def registrar(self, etapa, ms):
+        with self._lock:
+            muestras = self._etapas.get(etapa)
+            if muestras is None:
+                muestras = self._etapas[etapa] = deque(maxlen=self.max_muestras)
+            muestras.append(ms)
+
+    @contextmanager
+    def medir(self, etapa, traza=None):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            self.registrar(etapa, ms)
+            if traza is not None:
+                traza[etapa] = round(traza.get(etapa, 0) + ms, 3)
+
+    def cerrar_traza(self, traza):
+        with self._lock:
+            self._trazas.append(traza)
+        if log_latencias.isEnabledFor(logging.INFO):
+            log_latencias.info(json.dumps(traza, ensure_ascii=False))
+
+    def resumen(self):
+        # [{"etapa", "n", "p50", "p95", "p99", "max"}, ...] en ms
+        with self._lock:
+            copias = {etapa: sorted(muestras) for etapa, muestras in self._etapas.items()}
+        filas = []
+        for etapa, orden in sorted(copias.items()):
+            if not orden:
+                continue
+            pct = lambda p: round(orden[min(len(orden) - 1, int(len(orden) * p))], 2)
+            filas.append({"etapa": etapa, "n": len(orden), "p50": pct(0.50), "p95": pct(0.95),
+                          "p99": pct(0.99), "max": round(orden[-1], 2)})
+        return filas
+
+    def exportar(self):
+        # Trazas recientes en JSON Lines, una lectura por renglón
+        with self._lock:
+            trazas = list(self._trazas)
+        return "\n".join(json.dumps(t, ensure_ascii=False) for t in trazas)
+
+    def reiniciar(self):
+        with self._lock:
+            self._etapas.clear()
+            self._trazas.clear()
+
+
+# ================= CARGA INICIAL CON ESPERA CRECIENTE =================
+# Las cachés de la Puerta de Entrada se cargan en la primera lectura y, si la
+# base no respondió, se reintenta en las siguientes. Entre un intento fallido y
+# el siguiente se esperan ESPERA_CARGA segundos, el doble cada vez hasta
+# ESPERA_MAXIMA_CARGA, para que un kiosko sin red no pague el tiempo límite de
+# la conexión en cada credencial.
+ESPERA_CARGA = 2
+ESPERA_MAXIMA_CARGA = 60
+
+
+class EsperaCreciente:
+    def __init__(self, inicial=ESPERA_CARGA, maxima=ESPERA_MAXIMA_CARGA):
+        self.maxima = maxima
+        self.espera = inicial
+        self.ultimo_error = None
+        self._siguiente = 0.0
+
+    def comprobar(self):
+        # Antes de intentar: falla sin ir a la base mientras dure la espera
+        restante = self._siguiente - time.monotonic()
+        if restante > 0:
+            raise RuntimeError(f"{self.ultimo_error} (siguiente intento en {restante:.0f} s)")
+
+    def fallo(self, error):
+        self.ultimo_error = error
+        self._siguiente = time.monotonic() + self.espera
+        self.espera = min(self.espera * 2, self.maxima)
+
+
+# ================= SINCRONIZACIÓN POR CURSOR =================
+# Base del padrón y de los avisos en memoria: se cargan completos al iniciar y
+# un hilo trae cada 'intervalo' segundos solo las filas con 'updated_at' mayor
+# que el cursor. Si la tabla no tiene esa columna (PostgREST responde 42703) se
+# quedan sin refresco incremental; cualquier otro error se propaga, así una
+# caída de red al arrancar no apaga el modo incremental para siempre.
+#
+# 'updated_at' se fija al escribir, no al confirmar: una transacción lenta puede
+# aparecer con una marca anterior al cursor. Por eso cada refresco relee los
+# últimos MARGEN_CURSOR segundos y cada RECARGA_COMPLETA segundos se lee todo
+# de nuevo, lo que acota cuánto puede durar una fila que se saltó el cursor.
+MARGEN_CURSOR = 30
+RECARGA_COMPLETA = 600
+
+
+def _marca_menos(marca, segundos):
+    # 'updated_at' llega como texto ISO 8601; si no se entiende, sin margen
+    try:
+        return (datetime.fromisoformat(marca) - timedelta(seconds=segundos)).isoformat()
+    except (TypeError, ValueError):
+        return marca
+
+
+class SincronizadoPorCursor(abc.ABC):
+    TABLA = None
+    COLUMNAS = None
+
+    def __init__(self, cliente, intervalo, recarga=RECARGA_COMPLETA):
+        self.cliente = cliente
+        self.intervalo = intervalo
+        self.recarga = recarga
+        self.cargado = False
+        self.metricas = {"refrescos": 0, "recargas": 0, "errores_refresco": 0}
+        self._lock = threading.Lock()
+        self._lock_carga = threading.Lock()
+        self._incremental = True  # False si la tabla no tiene 'updated_at'
+        self._cursor = None       # 'updated_at' más reciente visto
+        self._espera_carga = EsperaCreciente()
+
+    @staticmethod
+    def _sin_updated_at(error):
+        return isinstance(error, APIError) and error.code == "42703"
+
+    def _columnas(self):
+        return self.COLUMNAS + (", updated_at" if self._incremental else "")
+
+    def _avanzar_cursor(self, fila):
+        marca = fila.get("updated_at")
+        if marca and (self._cursor is None or marca > self._cursor):
+            self._cursor = marca
+
+    def _cambios(self):
+        # Filas modificadas después del cursor menos el margen (todas si aún no
+        # hay cursor); releer las del margen no cambia nada
+        consulta = self.cliente.table(self.TABLA).select(self._columnas())
+        if self._cursor is not None:
+            consulta = consulta.gte("updated_at", _marca_menos(self._cursor, MARGEN_CURSOR))
+        return consulta.order("updated_at").execute().data or []
+
+    @abc.abstractmethod
+    def cargar(self):
+        # Lectura completa de la tabla; también la usa la recarga periódica
+        ...
+
+    @abc.abstractmethod
+    def refrescar(self):
+        # Trae solo lo que cambió desde el cursor
+        ...
+
+    def _ciclo_refresco(self):
+        ultima_carga = time.monotonic()
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                if time.monotonic() - ultima_carga >= self.recarga:
+                    self.cargar()
+                    ultima_carga = time.monotonic()
+                    self.metricas["recargas"] += 1
+                else:
+                    self.refrescar()
+            except Exception:
+                self.metricas["errores_refresco"] += 1
+
+    def asegurar_carga(self):
+        with self._lock_carga:
+            if self.cargado:
+                return
+            self._espera_carga.comprobar()
+            try:
+                self.cargar()
+            except Exception as e:
+                self._espera_carga.fallo(e)
+                raise
+            self.cargado = True
+            threading.Thread(target=self._ciclo_refresco, daemon=True).start()
+
+
+# ================= PADRÓN DE ALUMNOS EN MEMORIA (PUERTA DE ENTRADA) =================
+# El kiosko resuelve nombre, grupo y estatus sin ir a la base en cada lectura.
+# Se carga completo al iniciar, se refresca por cambios ('updated_at', ver
+# sql/001_padron_alumnos.sql) y cada alumno caduca a los TTL_PADRON segundos
+# si el refresco deja de funcionar, para que un bloqueo nunca tarde más que eso.
+# Mientras el refresco funcione la vigencia cuenta desde el último refresco; lo
+# que el cursor se salte lo corrige el margen o la recarga completa.
+TTL_PADRON = 60
+INTERVALO_REFRESCO_PADRON = 5
+COLUMNAS_PADRON = "matricula, nombre, grupo, estatus"
+
+
+class PadronAlumnos(SincronizadoPorCursor):
+    TABLA = "alumnos"
+    COLUMNAS = COLUMNAS_PADRON
+
+    def __init__(self, cliente, ttl=TTL_PADRON, intervalo=INTERVALO_REFRESCO_PADRON, recarga=RECARGA_COMPLETA):
+        super().__init__(cliente, intervalo, recarga)
+        self.ttl = ttl
+        self.metricas = {"aciertos": 0, "fallos": 0, "caducados": 0, **self.metricas}
+        self._alumnos = {}        # matricula -> (fila, instante en que se leyó)
+        self._ultima_sync = 0.0   # último refresco incremental exitoso
+
+    def _guardar(self, filas, instante):
+        for fila in filas:
+            mat = normalizar_matricula(fila.get("matricula"))
+            if mat:
+                self._alumnos[mat] = (fila, instante)
+            self._avanzar_cursor(fila)
+
+    def _leer_todo(self):
+        return [f for pagina in leer_paginado(self.cliente, "alumnos", self._columnas(), clave="matricula")
+                for f in pagina]
+
+    def cargar(self):
+        instante = time.monotonic()
+        try:
+            filas = self._leer_todo()
+        except APIError as e:
+            if not self._sin_updated_at(e):
+                raise
+            # Base sin la columna 'updated_at': solo quedan el TTL y la recarga completa
+            self._incremental = False
+            filas = self._leer_todo()
+        with self._lock:
+            self._alumnos.clear()
+            self._guardar(filas, instante)
+            self._ultima_sync = instante if self._incremental else 0.0
+
+    def refrescar(self):
+        if not self._incremental or self._cursor is None:
+            return
+        instante = time.monotonic()
+        filas = self._cambios()
+        with self._lock:
+            self._guardar(filas, instante)
+            self._ultima_sync = instante
+            self.metricas["refrescos"] += 1
+
+    def obtener(self, mat):
+        # Solo memoria: un fallo se resuelve con registrar_escaneo en el mismo viaje
+        with self._lock:
+            registro = self._alumnos.get(mat)
+            if registro:
+                vigente_desde = max(registro[1], self._ultima_sync)
+                if time.monotonic() - vigente_desde <= self.ttl:
+                    self.metricas["aciertos"] += 1
+                    return registro[0]
+                self.metricas["caducados"] += 1
+            self.metricas["fallos"] += 1
+            return None
+
+    def ultimo_conocido(self, mat):
+        # Sin conexión vale más el último dato leído que rechazar al alumno
+        with self._lock:
+            registro = self._alumnos.get(mat)
+            return registro[0] if registro else None
+
+    def actualizar(self, mat, fila):
+        with self._lock:
+            self._alumnos[mat] = (fila, time.monotonic())
+
+    def invalidar(self, mat):
+        with self._lock:
+            self._alumnos.pop(normalizar_matricula(mat), None)
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.metricas["aciertos"] + self.metricas["fallos"]
+            return {
+                **self.metricas,
+                "alumnos": len(self._alumnos),
+                "tasa_aciertos": round(100 * self.metricas["aciertos"] / consultas, 1) if consultas else 0.0,
+                "incremental": self._incremental,
+            }
+
+
+# ================= AVISOS ACTIVOS EN MEMORIA (PUERTA DE ENTRADA) =================
+# Cada kiosko guarda los avisos activos por matrícula y los mantiene al día con
+# un cursor sobre 'avisos.updated_at' (sql/008), así un aviso nuevo o retirado
+# llega en segundos sin consultar 'avisos' en cada lectura. El cliente se pasa
+# al construirla para poder probar la sincronización con un sustituto local
+# (ver prueba_carga.py).
+INTERVALO_REFRESCO_AVISOS = 3
+COLUMNAS_AVISOS = "id, matricula, mensaje, prioridad, activo"
+
+
+class AvisosActivos(SincronizadoPorCursor):
+    TABLA = "avisos"
+    COLUMNAS = COLUMNAS_AVISOS
+
+    def __init__(self, cliente, intervalo=INTERVALO_REFRESCO_AVISOS, recarga=RECARGA_COMPLETA):
+        super().__init__(cliente, intervalo, recarga)
+        self.metricas = {"cambios": 0, **self.metricas}
+        self._avisos = {}         # matricula -> {id: aviso}
+
+    def _aplicar(self, filas):
+        for fila in filas:
+            mat = normalizar_matricula(fila.get("matricula"))
+            if mat:
+                del_alumno = self._avisos.setdefault(mat, {})
+                if fila.get("activo"):
+                    del_alumno[fila["id"]] = {"mensaje": fila.get("mensaje"), "prioridad": fila.get("prioridad")}
+                else:
+                    del_alumno.pop(fila["id"], None)
+                if not del_alumno:
+                    del self._avisos[mat]
+                self.metricas["cambios"] += 1
+            self._avanzar_cursor(fila)
+
+    def _leer_activos(self):
+        filas, ultimo = [], None
+        while True:
+            consulta = self.cliente.table("avisos").select(self._columnas()).eq("activo", True)
+            if ultimo is not None:
+                consulta = consulta.gt("id", ultimo)
+            pagina = consulta.order("id").limit(TAM_PAGINA).execute().data or []
+            filas.extend(pagina)
+            if len(pagina) < TAM_PAGINA:
+                return filas
+            ultimo = pagina[-1]["id"]
+
+    def cargar(self):
+        # El cursor se toma antes de leer, así lo que cambie mientras tanto
+        # vuelve a llegar en el siguiente refresco
+        cursor = None
+        if self._incremental:
+            try:
+                ultima = self.cliente.table("avisos").select("updated_at") \
+                    .order("updated_at", desc=True).limit(1).execute().data
+                cursor = ultima[0]["updated_at"] if ultima else None
+            except APIError as e:
+                if not self._sin_updated_at(e):
+                    raise
+                # Base sin la columna 'updated_at': se relee la lista completa
+                self._incremental = False
+        filas = self._leer_activos()
+        with self._lock:
+            self._avisos = {}
+            self._cursor = cursor
+            self._aplicar(filas)
+
+    def refrescar(self):
+        if not self._incremental:
+            self.cargar()
+            self.metricas["refrescos"] += 1
+            return
+        filas = self._cambios()
+        with self._lock:
+            self._aplicar(filas)
+            self.metricas["refrescos"] += 1
+
+    def obtener(self, mat):
+        # El aviso más reciente del alumno, como en registrar_escaneo
+        with self._lock:
+            del_alumno = self._avisos.get(mat)
+            return del_alumno[max(del_alumno)] if del_alumno else None
+
+    def estadisticas(self):
+        with self._lock:
+            return {**self.metricas, "alumnos": len(self._avisos), "incremental": self._incremental}
+
+
+# ================= ENTRADAS DEL DÍA EN MEMORIA =================
+# Conjunto de matrículas que ya entraron hoy. Se siembra con una sola consulta al
+# iniciar y a la medianoche (America/Mexico_City) y se actualiza con cada entrada
+# local; el índice único de sql/003_entradas_unicas.sql resuelve las carreras
+# entre kioskos.
+class EntradasDelDia:
+    def __init__(self, cliente, zona):
+        self.cliente = cliente
+        self.zona = zona
+        self.fecha = None
+        self.cargado = False
+        self._lock = threading.Lock()
+        self._lock_carga = threading.Lock()
+        self._espera_carga = EsperaCreciente()
+        self._matriculas = set()
+
+    def sembrar(self, fecha):
+        matriculas = set()
+        for pagina in leer_paginado(self.cliente, "entradas", "matricula", filtros=[("eq", "fecha", fecha)]):
+            matriculas.update(normalizar_matricula(f.get("matricula")) for f in pagina)
+        with self._lock:
+            # Conserva lo registrado localmente mientras corría la consulta
+            if self.fecha == fecha:
+                matriculas |= self._matriculas
+            self.fecha = fecha
+            self._matriculas = matriculas
+
+    def _ciclo_medianoche(self):
+        while True:
+            ahora = datetime.now(self.zona)
+            manana = self.zona.localize(datetime.combine(ahora.date() + timedelta(days=1), datetime.min.time()))
+            time.sleep(max((manana - ahora).total_seconds(), 1))
+            try:
+                self.sembrar(datetime.now(self.zona).strftime("%Y-%m-%d"))
+            except Exception:
+                pass  # contiene() arranca el día vacío y el índice único cubre el resto
+
+    def asegurar_carga(self):
+        with self._lock_carga:
+            if self.cargado:
+                return
+            self._espera_carga.comprobar()
+            try:
+                self.sembrar(datetime.now(self.zona).strftime("%Y-%m-%d"))
+            except Exception as e:
+                self._espera_carga.fallo(e)
+                raise
+            self.cargado = True
+            threading.Thread(target=self._ciclo_medianoche, daemon=True).start()
+
+    def _al_dia(self, fecha):
+        if self.fecha != fecha:
+            self.fecha = fecha
+            self._matriculas = set()
+
+    def contiene(self, mat, fecha):
+        with self._lock:
+            self._al_dia(fecha)
+            return mat in self._matriculas
+
+    def agregar(self, mat, fecha):
+        with self._lock:
+            self._al_dia(fecha)
+            self._matriculas.add(mat)
+
+    def __len__(self):
+        return len(self._matriculas)
+
+
+# ================= DIARIO LOCAL EN SQLITE =================
+# Base de las colas que deben sobrevivir a un reinicio sin red: lo pendiente
+# vive en la tabla 'pendientes' de un archivo SQLite y un hilo lo envía con
+# espera exponencial mientras la red no regrese. Lo que la base rechaza suma un
+# intento y pasa detrás de lo demás; tras MAX_INTENTOS se aparta en la tabla
+# 'rechazadas' del mismo archivo para revisarlo a mano, así nunca detiene a lo
+# que viene detrás.
+class DiarioLocal(abc.ABC):
+    CLAVE = "clave"         # columnas de 'pendientes' y 'rechazadas'
+    DATOS = "registro"
+    TIPO_DATOS = "text"
+    MAX_INTENTOS = 5
+    INTERVALO = 2
+    ESPERA_MAXIMA = 60
+
+    # cache: la CacheConsultas del servidor, para invalidar desde el hilo sin
+    # pasar por st.cache_resource
+    def __init__(self, cliente, ruta, cache=None, metricas=()):
+        self.cliente = cliente
+        self.cache = cache
+        self.ruta = ruta
+        self.metricas = {"encoladas": 0, **{m: 0 for m in metricas}, "rechazadas": 0, "errores": 0}
+        self.ultimo_error = None
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._db = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute(f"""
+            create table if not exists pendientes (
+                {self.CLAVE} text primary key,
+                {self.DATOS} {self.TIPO_DATOS} not null,
+                creado real not null,
+                intentos integer not null default 0
+            )
+        """)
+        self._db.execute(f"""
+            create table if not exists rechazadas (
+                {self.CLAVE} text primary key,
+                {self.DATOS} {self.TIPO_DATOS} not null,
+                error text,
+                creado real not null
+            )
+        """)
+        threading.Thread(target=self._ciclo, daemon=True).start()
+
+    def pendientes(self):
+        with self._lock:
+            return self._db.execute("select count(*) from pendientes").fetchone()[0]
+
+    def rechazadas(self):
+        with self._lock:
+            return self._db.execute("select count(*) from rechazadas").fetchone()[0]
+
+    def descartar(self, clave):
+        with self._lock:
+            self._db.execute(f"delete from pendientes where {self.CLAVE} = ?", (clave,))
+
+    def _siguientes(self, limite):
+        # Primero las que menos intentos llevan, en orden de llegada
+        with self._lock:
+            return self._db.execute(
+                f"select {self.CLAVE}, {self.DATOS} from pendientes order by intentos, creado limit ?", (limite,)
+            ).fetchall()
+
+    def _resolver(self, enviadas, errores):
+        # Borra lo enviado y suma un intento a lo rechazado ({clave: error}); lo
+        # que llega a MAX_INTENTOS pasa a 'rechazadas'. Devuelve cuántas se apartaron.
+        clave, datos = self.CLAVE, self.DATOS
+        ahora = time.time()
+        with self._lock:
+            self._db.execute("begin")
+            self._db.executemany(f"delete from pendientes where {clave} = ?", [(c,) for c in enviadas])
+            self._db.executemany(f"update pendientes set intentos = intentos + 1 where {clave} = ?",
+                                 [(c,) for c in errores])
+            self._db.executemany(
+                f"insert or replace into rechazadas ({clave}, {datos}, error, creado) "
+                f"select {clave}, {datos}, ?, ? from pendientes where {clave} = ? and intentos >= ?",
+                [(str(e), ahora, c, self.MAX_INTENTOS) for c, e in errores.items()])
+            apartadas = sum(
+                self._db.execute(f"delete from pendientes where {clave} = ? and intentos >= ?",
+                                 (c, self.MAX_INTENTOS)).rowcount
+                for c in errores)
+            self._db.execute("commit")
+            self.metricas["rechazadas"] += apartadas
+        return apartadas
+
+    @abc.abstractmethod
+    def _trabajar(self):
+        # Envía lo pendiente; una falla se propaga y el hilo espera antes de reintentar
+        ...
+
+    def _ciclo(self):
+        espera = self.INTERVALO
+        while True:
+            self._despertar.wait(espera)
+            self._despertar.clear()
+            try:
+                self._trabajar()
+                espera = self.INTERVALO
+            except Exception as e:
+                # Reintento con espera exponencial mientras la red no regrese
+                self.metricas["errores"] += 1
+                self.ultimo_error = str(e)
+                espera = min(espera * 2, self.ESPERA_MAXIMA)
+
+
+# ================= COLA LOCAL DE ENTRADAS (SIN CONEXIÓN) =================
+# Si Supabase no responde, la entrada se admite con el padrón en memoria y se
+# guarda en el diario local. El hilo la envía por lotes a 'entradas'; la clave
+# (matricula, fecha) hace que reenviar el mismo lote no duplique nada. Una fila
+# que la base rechaza (APIError) cuenta como intento fallido del diario.
+RUTA_COLA_ENTRADAS = os.environ.get("SICA_COLA_ENTRADAS", "cola_entradas.sqlite3")
+LOTE_COLA = 200
+INTERVALO_COLA = 2
+ESPERA_MAXIMA_COLA = 60
+MAX_INTENTOS_COLA = 5
+
+
+class ColaEntradas(DiarioLocal):
+    MAX_INTENTOS = MAX_INTENTOS_COLA
+    INTERVALO = INTERVALO_COLA
+    ESPERA_MAXIMA = ESPERA_MAXIMA_COLA
+
+    def __init__(self, cliente, ruta=RUTA_COLA_ENTRADAS, cache=None):
+        super().__init__(cliente, ruta, cache, metricas=("enviadas",))
+
+    @staticmethod
+    def _clave(registro):
+        return f"{registro['matricula']}|{registro['fecha']}"
+
+    def encolar(self, registro):
+        clave = self._clave(registro)
+        with self._lock:
+            self._db.execute(
+                "insert or ignore into pendientes (clave, registro, creado) values (?, ?, ?)",
+                (clave, json.dumps(registro), time.time())
+            )
+            self.metricas["encoladas"] += 1
+
+    def _enviar(self, registros):
+        _insertar_filas(self.cliente, "entradas", registros, on_conflict="matricula,fecha")
+
+    def vaciar_lote(self):
+        # Devuelve cuántas filas del lote se resolvieron (enviadas o rechazadas).
+        # Una falla de red se propaga y el hilo espera antes de reintentar.
+        filas = self._siguientes(LOTE_COLA)
+        if not filas:
+            return 0
+        registros = {clave: json.loads(registro) for clave, registro in filas}
+        enviadas, errores = [], {}
+        try:
+            self._enviar(list(registros.values()))
+            enviadas = list(registros)
+        except APIError:
+            # La base rechazó el lote: fila por fila para aislar las que fallan
+            for clave, registro in registros.items():
+                try:
+                    self._enviar([registro])
+                    enviadas.append(clave)
+                except APIError as e:
+                    errores[clave] = str(e)
+        self._resolver(enviadas, errores)
+        with self._lock:
+            self.metricas["enviadas"] += len(enviadas)
+        if enviadas and self.cache is not None:
+            self.cache.invalidar("entradas")
+        if errores:
+            self.ultimo_error = next(iter(errores.values()))
+        if not enviadas:
+            # Todo el lote rechazado: se espera antes del siguiente intento
+            raise RuntimeError(self.ultimo_error)
+        return len(filas)
+
+    def _trabajar(self):
+        while self.vaciar_lote() == LOTE_COLA:
+            pass
+
+
+# ================= EVIDENCIAS DE REPORTES (SUBIDA EN SEGUNDO PLANO) =================
+# La foto de la cámara se reduce a un JPEG acotado y se guarda en el diario
+# local. El reporte se escribe al momento con foto_url "pendiente:<archivo>" y
+# el hilo sube la imagen a 'evidencias' y reemplaza la marca por la URL pública.
+# Sin red la foto espera sin gastar intentos; si Storage o la base la rechazan
+# cuenta como intento fallido del diario.
+RUTA_COLA_EVIDENCIAS = os.environ.get("SICA_COLA_EVIDENCIAS", "cola_evidencias.sqlite3")
+MAX_LADO_EVIDENCIA = 1280
+MAX_BYTES_EVIDENCIA = 250 * 1024
+PREFIJO_FOTO_PENDIENTE = "pendiente:"
+INTERVALO_EVIDENCIAS = 2
+ESPERA_MAXIMA_EVIDENCIAS = 120
+MAX_INTENTOS_EVIDENCIAS = 5
+# Miniaturas para el Historial: misma cubeta, carpeta 'miniaturas/' (sql/010)
+LADO_MINIATURA = 240
+CARPETA_MINIATURAS = "miniaturas/"
+
+
+def comprimir_evidencia(datos, max_lado=MAX_LADO_EVIDENCIA, max_bytes=MAX_BYTES_EVIDENCIA):
+    with Image.open(BytesIO(datos)) as original:
+        img = ImageOps.exif_transpose(original).convert("RGB")
+    img.thumbnail((max_lado, max_lado))
+    calidad = 85
+    while True:
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=calidad, optimize=True)
+        if buf.tell() <= max_bytes or max(img.size) <= 320:
+            return buf.getvalue()
+        if calidad > 45:
+            calidad -= 10
+        else:
+            # Ni con calidad baja cabe: se reduce la imagen y se vuelve a intentar
+            lado = int(max(img.size) * 0.75)
+            img.thumbnail((lado, lado))
+            calidad = 75
+
+
+def miniatura_evidencia(datos, lado=LADO_MINIATURA):
+    with Image.open(BytesIO(datos)) as original:
+        img = ImageOps.exif_transpose(original).convert("RGB")
+    img.thumbnail((lado, lado))
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=70, optimize=True)
+    return buf.getvalue()
+
+
+def objeto_evidencia(url):
+    # Ruta dentro de 'evidencias' a partir de la URL pública, o None si es de otro lado
+    partes = str(url or "").split("/object/public/evidencias/", 1)
+    return partes[1].split("?", 1)[0] if len(partes) == 2 else None
+
+
+class ColaEvidencias(DiarioLocal):
+    CLAVE = "nombre"
+    DATOS = "datos"
+    TIPO_DATOS = "blob"
+    MAX_INTENTOS = MAX_INTENTOS_EVIDENCIAS
+    INTERVALO = INTERVALO_EVIDENCIAS
+    ESPERA_MAXIMA = ESPERA_MAXIMA_EVIDENCIAS
+
+    def __init__(self, cliente, ruta=RUTA_COLA_EVIDENCIAS, cache=None):
+        self._miniaturas = []          # fotos anteriores sin miniatura, en orden de petición
+        self._miniaturas_pedidas = set()
+        super().__init__(cliente, ruta, cache, metricas=("subidas", "miniaturas"))
+
+    def encolar(self, nombre, datos):
+        with self._lock:
+            self._db.execute(
+                "insert or replace into pendientes (nombre, datos, creado) values (?, ?, ?)",
+                (nombre, datos, time.time())
+            )
+            self.metricas["encoladas"] += 1
+        self._despertar.set()
+
+    def _invalidar_reportes(self):
+        if self.cache is not None:
+            self.cache.invalidar("reportes")
+
+    def _subir(self, nombre, datos):
+        # upsert: si se cayó después de subir, el reintento no choca con el archivo
+        cubeta = self.cliente.storage.from_("evidencias")
+        cubeta.upload(nombre, datos, {"content-type": "image/jpeg", "upsert": "true"})
+        return cubeta.get_public_url(nombre)
+
+    def pedir_miniatura(self, url):
+        # Para fotos subidas antes de que existieran las miniaturas: se genera
+        # la primera vez que alguien abre el Historial del alumno
+        objeto = objeto_evidencia(url)
+        if not objeto:
+            return
+        with self._lock:
+            if url in self._miniaturas_pedidas:
+                return
+            self._miniaturas_pedidas.add(url)
+            self._miniaturas.append((url, objeto))
+        self._despertar.set()
+
+    def generar_miniatura(self):
+        with self._lock:
+            if not self._miniaturas:
+                return False
+            url, objeto = self._miniaturas[0]
+        try:
+            original = self.cliente.storage.from_("evidencias").download(objeto)
+            url_min = self._subir(CARPETA_MINIATURAS + objeto, miniatura_evidencia(original))
+            self.cliente.table("reportes").update({"miniatura_url": url_min}).eq("foto_url", url).execute()
+        except Exception:
+            # Se saca de la fila para no trabar las demás; otra visita la vuelve a pedir
+            with self._lock:
+                self._miniaturas.pop(0)
+                self._miniaturas_pedidas.discard(url)
+            raise
+        self._invalidar_reportes()
+        with self._lock:
+            self._miniaturas.pop(0)
+            self.metricas["miniaturas"] += 1
+        return True
+
+    def subir_siguiente(self):
+        filas = self._siguientes(1)
+        if not filas:
+            return False
+        nombre, datos = filas[0]
+        try:
+            url = self._subir(nombre, datos)
+            url_min = self._subir(CARPETA_MINIATURAS + nombre, miniatura_evidencia(datos))
+            actualizados = self.cliente.table("reportes").update({"foto_url": url, "miniatura_url": url_min}) \
+                .eq("foto_url", PREFIJO_FOTO_PENDIENTE + nombre).execute().data
+            if not actualizados:
+                # La foto se encola antes de guardar el reporte: si aún no está,
+                # cuenta como intento y se vuelve a probar después
+                raise RuntimeError(f"ningún reporte espera la foto {nombre}")
+        except Exception as e:
+            if not falla_de_red(e):
+                self._resolver([], {nombre: e})
+            raise
+        self._invalidar_reportes()
+        self._resolver([nombre], {})
+        with self._lock:
+            self.metricas["subidas"] += 1
+        return True
+
+    def _trabajar(self):
+        # Wi-Fi caído o Storage sin responder: la foto sigue en disco
+        while self.subir_siguiente():
+            pass
+        while self.generar_miniatura():
+            pass
+
+
+# Corte de red: tras una falla de transporte en registrar_escaneo las lecturas
+# de alumnos conocidos van directo a la cola local durante PAUSA_SIN_RED
+# segundos, sin pagar el tiempo límite de la conexión en cada credencial. Un
+# hilo sondea la base cada INTERVALO_SONDEO segundos y reabre el paso en cuanto
+# contesta; si sigue sin contestar la pausa se renueva.
+PAUSA_SIN_RED = 30
+INTERVALO_SONDEO = 5
+
+
+class ServicioEscaneo:
+    def __init__(self, cliente, padron, entradas, avisos, cola, zona, latencias=None,
+                 pausa_sin_red=PAUSA_SIN_RED, intervalo_sondeo=INTERVALO_SONDEO):
+        self.cliente = cliente
+        self.padron = padron
+        self.entradas = entradas
+        self.avisos = avisos
+        self.cola = cola
+        self.zona = zona
+        self.latencias = latencias or Latencias()
+        self.pausa_sin_red = pausa_sin_red
+        self.intervalo_sondeo = intervalo_sondeo
+        self.metricas = Counter()
+        self.cortes_red = 0
+        self._lock = threading.Lock()
+        self._en_curso = {}  # matricula -> [lock, lecturas esperando]
+        self._sin_red_hasta = 0.0
+        self._sondeando = False
+        self._omitir_aviso = True  # False si la base no tiene sql/011
+
+    def _tomar(self, mat):
+        with self._lock:
+            turno = self._en_curso.setdefault(mat, [threading.Lock(), 0])
+            turno[1] += 1
+        turno[0].acquire()
+        return turno
+
+    def _soltar(self, mat, turno):
+        turno[0].release()
+        with self._lock:
+            turno[1] -= 1
+            if not turno[1]:
+                del self._en_curso[mat]
+
+    def sin_red(self):
+        return time.monotonic() < self._sin_red_hasta
+
+    def _cortar_red(self):
+        with self._lock:
+            self._sin_red_hasta = time.monotonic() + self.pausa_sin_red
+            self.cortes_red += 1
+            if self._sondeando:
+                return
+            self._sondeando = True
+        threading.Thread(target=self._sondear, daemon=True).start()
+
+    def _sondear(self):
+        # Cualquier respuesta de la base, aun un APIError, reabre el paso
+        while True:
+            time.sleep(self.intervalo_sondeo)
+            try:
+                self.cliente.table("alumnos").select("matricula").limit(1).execute()
+            except Exception as e:
+                if falla_de_red(e):
+                    with self._lock:
+                        self._sin_red_hasta = time.monotonic() + self.pausa_sin_red
+                    continue
+            with self._lock:
+                self._sin_red_hasta = 0.0
+                self._sondeando = False
+            return
+
+    def _registrar(self, mat, registro_por, ahora):
+        # Con los avisos en memoria la base no necesita buscarlos en cada lectura
+        if self._omitir_aviso and self.avisos.cargado:
+            try:
+                return registrar_escaneo(self.cliente, mat, registro_por, ahora, con_aviso=False)
+            except APIError as e:
+                if e.code != "PGRST202":
+                    raise
+                # Base sin sql/011: registrar_escaneo aún no acepta p_con_aviso
+                self._omitir_aviso = False
+        return registrar_escaneo(self.cliente, mat, registro_por, ahora)
+
+    def _contar(self, resultado):
+        with self._lock:
+            self.metricas["lecturas"] += 1
+            self.metricas[resultado["tipo"]] += 1
+        return resultado
+
+    def escanear(self, mat_raw, registro_por="Sistema"):
+        # Devuelve el resultado que pinta el kiosko ({"tipo": ok/warning/bloqueado/error, ...})
+        # o None si la lectura venía vacía. Los errores sin salida se propagan.
+        t0 = time.perf_counter()
+        traza = {"inicio": datetime.now(self.zona).isoformat(timespec="milliseconds"), "puerta": registro_por}
+        with self.latencias.medir("normalizacion", traza):
+            mat = normalizar_matricula(mat_raw)
+        if not mat:
+            return None
+        traza["matricula"] = mat
+        try:
+            # Dos puertas con la misma credencial se atienden en orden: la segunda
+            # ya encuentra la entrada en memoria y no vuelve a ir a la base
+            with self.latencias.medir("espera_turno", traza):
+                turno = self._tomar(mat)
+            try:
+                resultado = self._contar(self._procesar(mat, registro_por, traza))
+            finally:
+                self._soltar(mat, turno)
+            traza["resultado"] = resultado["tipo"]
+            return resultado
+        except Exception as e:
+            traza["resultado"] = "excepcion"
+            traza["error"] = str(e)
+            raise
+        finally:
+            traza["total"] = round((time.perf_counter() - t0) * 1000, 3)
+            self.latencias.registrar("total", traza["total"])
+            self.latencias.cerrar_traza(traza)
+
+    def _procesar(self, mat, registro_por, traza):
+        medir = self.latencias.medir
+        with medir("padron", traza):
+            al = self.padron.obtener(mat)
+
+        if al and al.get("estatus") is False:
+            # Bloqueo conocido en memoria: no hace falta ir a la base
+            return {
+                "tipo": "bloqueado",
+                "nombre": al.get("nombre"),
+                "mensaje": "ACCESO DENEGADO / BLOQUEADO"
+            }
+
+        # ================= EVITAR DOBLE ENTRADA EL MISMO DÍA =================
+        ahora = datetime.now(self.zona)
+        fecha_hoy = ahora.strftime("%Y-%m-%d")
+        with medir("duplicado", traza):
+            repetida = self.entradas.contiene(mat, fecha_hoy)
+        if repetida:
+            return {
+                "tipo": "warning",
+                "nombre": al.get("nombre") if al else None,
+                "mensaje": "ENTRADA YA REGISTRADA HOY"
+            }
+
+        # Sin conexión solo se admite a quien el padrón conoce y no está bloqueado
+        al = al or self.padron.ultimo_conocido(mat)
+        admisible = al is not None and al.get("estatus") is not False
+        if admisible and self.sin_red():
+            return self._admitir_sin_red(mat, al, ahora, registro_por, traza)
+        try:
+            with medir("rpc", traza):
+                r = self._registrar(mat, registro_por, ahora)
+        except Exception as e:
+            if not falla_de_red(e):
+                raise
+            self._cortar_red()
+            if not admisible:
+                raise
+            return self._admitir_sin_red(mat, al, ahora, registro_por, traza)
+
+        if not r.get("encontrado"):
+            self.padron.invalidar(mat)
+            return {
+                "tipo": "error",
+                "mensaje": "MATRÍCULA NO REGISTRADA"
+            }
+
+        self.padron.actualizar(mat, {
+            "matricula": mat,
+            "nombre": r.get("nombre"),
+            "grupo": r.get("grupo"),
+            "estatus": r.get("estatus")
+        })
+
+        if r.get("estatus") is False:
+            return {
+                "tipo": "bloqueado",
+                "nombre": r.get("nombre"),
+                "mensaje": "ACCESO DENEGADO / BLOQUEADO"
+            }
+
+        self.entradas.agregar(mat, fecha_hoy)
+        if r.get("ya_registrada"):
+            # Otro servidor la registró primero
+            return {
+                "tipo": "warning",
+                "nombre": r.get("nombre"),
+                "mensaje": "ENTRADA YA REGISTRADA HOY"
+            }
+
+        with medir("avisos", traza):
+            aviso = self.avisos.obtener(mat) if self.avisos.cargado else r.get("aviso")
+        return {
+            "tipo": "ok",
+            "nombre": r.get("nombre"),
+            "grupo": r.get("grupo"),
+            "aviso": aviso
+        }
+
+    def _admitir_sin_red(self, mat, al, ahora, registro_por, traza):
+        # Se admite con el padrón y la entrada espera en la cola local
+        fecha_hoy = ahora.strftime("%Y-%m-%d")
+        with self.latencias.medir("cola_local", traza):
+            self.cola.encolar({
+                "fecha": fecha_hoy,
+                "hora": ahora.strftime("%H:%M:%S"),
+                "matricula": mat,
+                "nombre": al.get("nombre", "N/A"),
+                "grupo": al.get("grupo", "N/A"),
+                "registro_por": registro_por
+            })
+            self.entradas.agregar(mat, fecha_hoy)
+        with self.latencias.medir("avisos", traza):
+            aviso = self.avisos.obtener(mat)
+        return {
+            "tipo": "ok",
+            "nombre": al.get("nombre"),
+            "grupo": al.get("grupo"),
+            "aviso": aviso
+        }
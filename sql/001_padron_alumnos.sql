@@ -0,0 +1,18 @@
+-- Marca de cambio en 'alumnos' para el refresco incremental del padrón
+-- que mantienen en memoria los kioskos de la Puerta de Entrada.
+alter table alumnos add column if not exists updated_at timestamptz not null default now();
+
+create or replace function tocar_updated_at() returns trigger
+language plpgsql as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists alumnos_updated_at on alumnos;
+create trigger alumnos_updated_at
+    before update on alumnos
+    for each row execute function tocar_updated_at();
+
+create index if not exists alumnos_updated_at_idx on alumnos (updated_at);
@@ -0,0 +1,58 @@
+-- Resolución completa de un escaneo de la Puerta de Entrada en un solo viaje:
+-- alumno, aviso activo, entrada previa del día y registro de la entrada.
+-- Se asume 'entradas.fecha' de tipo date y 'entradas.hora' de tipo time.
+create or replace function registrar_escaneo(
+    p_matricula text,
+    p_fecha date,
+    p_hora time,
+    p_registro_por text
+) returns json
+language plpgsql as $$
+declare
+    v_alumno alumnos%rowtype;
+    v_aviso json;
+    v_ya_registrada boolean;
+begin
+    select * into v_alumno from alumnos where matricula = p_matricula;
+    if not found then
+        return json_build_object('encontrado', false);
+    end if;
+
+    if v_alumno.estatus is false then
+        return json_build_object(
+            'encontrado', true,
+            'nombre', v_alumno.nombre,
+            'grupo', v_alumno.grupo,
+            'estatus', false
+        );
+    end if;
+
+    select json_build_object('mensaje', mensaje, 'prioridad', prioridad) into v_aviso
+    from avisos
+    where matricula = p_matricula and activo
+    order by id desc
+    limit 1;
+
+    select exists (
+        select 1 from entradas where matricula = p_matricula and fecha = p_fecha
+    ) into v_ya_registrada;
+
+    if not v_ya_registrada then
+        insert into entradas (fecha, hora, matricula, nombre, grupo, registro_por)
+        values (
+            p_fecha, p_hora, p_matricula,
+            coalesce(v_alumno.nombre, 'N/A'), coalesce(v_alumno.grupo, 'N/A'),
+            coalesce(p_registro_por, 'Sistema')
+        );
+    end if;
+
+    return json_build_object(
+        'encontrado', true,
+        'nombre', v_alumno.nombre,
+        'grupo', v_alumno.grupo,
+        'estatus', coalesce(v_alumno.estatus, true),
+        'aviso', v_aviso,
+        'ya_registrada', v_ya_registrada
+    );
+end;
+$$;
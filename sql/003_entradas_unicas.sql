@@ -0,0 +1,63 @@
+-- Una sola entrada por alumno y día, aunque dos kioskos lean la misma credencial
+-- al mismo tiempo. Antes de crear el índice se eliminan los duplicados que ya
+-- existan, conservando el registro más antiguo.
+delete from entradas a
+using entradas b
+where a.matricula = b.matricula
+  and a.fecha = b.fecha
+  and a.id > b.id;
+
+create unique index if not exists entradas_matricula_fecha_key on entradas (matricula, fecha);
+
+-- registrar_escaneo deja que el índice decida la doble entrada
+create or replace function registrar_escaneo(
+    p_matricula text,
+    p_fecha date,
+    p_hora time,
+    p_registro_por text
+) returns json
+language plpgsql as $$
+declare
+    v_alumno alumnos%rowtype;
+    v_aviso json;
+    v_insertadas integer;
+begin
+    select * into v_alumno from alumnos where matricula = p_matricula;
+    if not found then
+        return json_build_object('encontrado', false);
+    end if;
+
+    if v_alumno.estatus is false then
+        return json_build_object(
+            'encontrado', true,
+            'nombre', v_alumno.nombre,
+            'grupo', v_alumno.grupo,
+            'estatus', false
+        );
+    end if;
+
+    select json_build_object('mensaje', mensaje, 'prioridad', prioridad) into v_aviso
+    from avisos
+    where matricula = p_matricula and activo
+    order by id desc
+    limit 1;
+
+    insert into entradas (fecha, hora, matricula, nombre, grupo, registro_por)
+    values (
+        p_fecha, p_hora, p_matricula,
+        coalesce(v_alumno.nombre, 'N/A'), coalesce(v_alumno.grupo, 'N/A'),
+        coalesce(p_registro_por, 'Sistema')
+    )
+    on conflict (matricula, fecha) do nothing;
+    get diagnostics v_insertadas = row_count;
+
+    return json_build_object(
+        'encontrado', true,
+        'nombre', v_alumno.nombre,
+        'grupo', v_alumno.grupo,
+        'estatus', coalesce(v_alumno.estatus, true),
+        'aviso', v_aviso,
+        'ya_registrada', v_insertadas = 0
+    );
+end;
+$$;
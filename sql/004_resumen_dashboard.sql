@@ -0,0 +1,37 @@
+-- Métricas del Dashboard directivo calculadas en la base: la página recibe
+-- solo filas agregadas, sin importar cuánto historial tengan las tablas.
+create index if not exists entradas_fecha_idx on entradas (fecha);
+create index if not exists reportes_matricula_idx on reportes (matricula);
+
+create or replace function resumen_dashboard() returns json
+language sql stable as $$
+    select json_build_object(
+        'total_entradas', (select count(*) from entradas),
+        'total_reportes', (select count(*) from reportes),
+        'casos_graves', (select count(*) from reportes where upper(nivel) = 'REPORTE'),
+        'motivo_comun', (
+            select tipo from reportes
+            where tipo is not null
+            group by tipo
+            order by count(*) desc, tipo
+            limit 1
+        ),
+        'reportes_por_grupo', coalesce((
+            select json_agg(g order by g.conteo desc)
+            from (
+                select coalesce(a.grupo, 'SIN GRUPO') as grupo, count(*) as conteo
+                from reportes r
+                left join alumnos a on a.matricula = r.matricula
+                group by 1
+            ) g
+        ), '[]'::json),
+        'asistencia_diaria', coalesce((
+            select json_agg(d order by d.fecha)
+            from (
+                select fecha, count(*) as asistencias
+                from entradas
+                group by fecha
+            ) d
+        ), '[]'::json)
+    );
+$$;
@@ -0,0 +1,92 @@
+-- Conteo de entradas por día, grupo y hora, mantenido por trigger al registrar
+-- cada entrada. La tendencia de asistencia lee unos cientos de filas de aquí en
+-- lugar de recorrer todo 'entradas'. 'entradas.fecha' y 'entradas.hora' pueden
+-- ser date/time o texto ISO (la app guarda strftime); se convierten con ::date/::time.
+create table if not exists asistencia_resumen (
+    fecha date not null,
+    grupo text not null,
+    hora smallint not null,
+    total integer not null default 0,
+    primary key (fecha, grupo, hora)
+);
+
+create or replace function sumar_asistencia_resumen() returns trigger
+language plpgsql as $$
+begin
+    if tg_op = 'INSERT' then
+        insert into asistencia_resumen (fecha, grupo, hora, total)
+        values (new.fecha::date, coalesce(new.grupo, 'N/A'), extract(hour from new.hora::time)::smallint, 1)
+        on conflict (fecha, grupo, hora)
+        do update set total = asistencia_resumen.total + 1;
+        return new;
+    end if;
+
+    update asistencia_resumen
+    set total = total - 1
+    where fecha = old.fecha::date
+      and grupo = coalesce(old.grupo, 'N/A')
+      and hora = extract(hour from old.hora::time)::smallint;
+    return old;
+end;
+$$;
+
+drop trigger if exists entradas_asistencia_resumen on entradas;
+create trigger entradas_asistencia_resumen
+    after insert or delete on entradas
+    for each row execute function sumar_asistencia_resumen();
+
+-- Reconstrucción desde el historial: select reconstruir_asistencia_resumen();
+-- Con 'p_desde' solo recalcula a partir de esa fecha.
+create or replace function reconstruir_asistencia_resumen(p_desde date default null) returns integer
+language plpgsql as $$
+declare
+    v_filas integer;
+begin
+    delete from asistencia_resumen where p_desde is null or fecha >= p_desde;
+
+    insert into asistencia_resumen (fecha, grupo, hora, total)
+    select fecha::date, coalesce(grupo, 'N/A'), extract(hour from hora::time)::smallint, count(*)
+    from entradas
+    where p_desde is null or fecha::date >= p_desde
+    group by 1, 2, 3;
+
+    get diagnostics v_filas = row_count;
+    return v_filas;
+end;
+$$;
+
+select reconstruir_asistencia_resumen();
+
+-- El Dashboard toma asistencias del resumen en vez de contar 'entradas'
+create or replace function resumen_dashboard() returns json
+language sql stable as $$
+    select json_build_object(
+        'total_entradas', (select coalesce(sum(total), 0) from asistencia_resumen),
+        'total_reportes', (select count(*) from reportes),
+        'casos_graves', (select count(*) from reportes where upper(nivel) = 'REPORTE'),
+        'motivo_comun', (
+            select tipo from reportes
+            where tipo is not null
+            group by tipo
+            order by count(*) desc, tipo
+            limit 1
+        ),
+        'reportes_por_grupo', coalesce((
+            select json_agg(g order by g.conteo desc)
+            from (
+                select coalesce(a.grupo, 'SIN GRUPO') as grupo, count(*) as conteo
+                from reportes r
+                left join alumnos a on a.matricula = r.matricula
+                group by 1
+            ) g
+        ), '[]'::json),
+        'asistencia_diaria', coalesce((
+            select json_agg(d order by d.fecha)
+            from (
+                select fecha, sum(total) as asistencias
+                from asistencia_resumen
+                group by fecha
+            ) d
+        ), '[]'::json)
+    );
+$$;
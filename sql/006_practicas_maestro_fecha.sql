@@ -0,0 +1,2 @@
+-- Historial de prácticas por docente y mes: filtro por maestro y rango de fecha
+create index if not exists practicas_talleres_maestro_fecha_idx on practicas_talleres (maestro, fecha);
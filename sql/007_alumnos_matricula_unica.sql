@@ -0,0 +1,3 @@
+-- La importación del padrón guarda con upsert sobre la matrícula, que
+-- necesita una restricción única en esa columna.
+create unique index if not exists alumnos_matricula_key on alumnos (matricula);
@@ -0,0 +1,11 @@
+-- Marca de cambio en 'avisos' para que los kioskos mantengan en memoria los
+-- avisos activos con un cursor, igual que el padrón (ver 001).
+alter table avisos add column if not exists updated_at timestamptz not null default now();
+
+drop trigger if exists avisos_updated_at on avisos;
+create trigger avisos_updated_at
+    before update on avisos
+    for each row execute function tocar_updated_at();
+
+create index if not exists avisos_updated_at_idx on avisos (updated_at);
+create index if not exists avisos_activos_idx on avisos (id) where activo;
@@ -0,0 +1,65 @@
+-- Resumen de reportes por alumno (total, último nivel y última fecha),
+-- mantenido por trigger. "Reportes" sugiere el nivel y "Expediente Digital"
+-- calcula el riesgo leyendo una sola fila en lugar de contar 'reportes'.
+-- 'reportes.fecha' puede ser date o texto ISO; se convierte con ::date.
+create table if not exists incidencias_alumno (
+    matricula text primary key,
+    total integer not null default 0,
+    ultimo_nivel text,
+    ultima_fecha date
+);
+
+create or replace function sumar_incidencias_alumno() returns trigger
+language plpgsql as $$
+begin
+    if tg_op = 'INSERT' then
+        insert into incidencias_alumno (matricula, total, ultimo_nivel, ultima_fecha)
+        values (new.matricula, 1, new.nivel, new.fecha::date)
+        on conflict (matricula) do update set
+            total = incidencias_alumno.total + 1,
+            ultimo_nivel = case when excluded.ultima_fecha >= coalesce(incidencias_alumno.ultima_fecha, excluded.ultima_fecha)
+                                then excluded.ultimo_nivel else incidencias_alumno.ultimo_nivel end,
+            ultima_fecha = greatest(incidencias_alumno.ultima_fecha, excluded.ultima_fecha);
+        return new;
+    end if;
+
+    -- Al borrar, el último reporte se vuelve a tomar de los que quedan del alumno
+    update incidencias_alumno
+    set total = total - 1,
+        ultimo_nivel = (select nivel from reportes where matricula = old.matricula
+                        order by fecha desc, id desc limit 1),
+        ultima_fecha = (select max(fecha::date) from reportes where matricula = old.matricula)
+    where matricula = old.matricula;
+    return old;
+end;
+$$;
+
+drop trigger if exists reportes_incidencias_alumno on reportes;
+create trigger reportes_incidencias_alumno
+    after insert or delete on reportes
+    for each row execute function sumar_incidencias_alumno();
+
+-- Reconstrucción desde el historial: select reconstruir_incidencias_alumno();
+create or replace function reconstruir_incidencias_alumno() returns integer
+language plpgsql as $$
+declare
+    v_filas integer;
+begin
+    delete from incidencias_alumno;
+
+    insert into incidencias_alumno (matricula, total, ultimo_nivel, ultima_fecha)
+    select distinct on (matricula)
+        matricula,
+        count(*) over (partition by matricula),
+        nivel,
+        fecha::date
+    from reportes
+    where matricula is not null
+    order by matricula, fecha desc, id desc;
+
+    get diagnostics v_filas = row_count;
+    return v_filas;
+end;
+$$;
+
+select reconstruir_incidencias_alumno();
@@ -0,0 +1,3 @@
+-- URL de la miniatura de la evidencia (carpeta 'miniaturas/' de la cubeta
+-- 'evidencias'). El Historial la muestra en la lista y abre 'foto_url' al dar clic.
+alter table reportes add column if not exists miniatura_url text;
@@ -0,0 +1,61 @@
+-- Los kioskos con los avisos en memoria (AvisosActivos, sql/008) no necesitan
+-- que registrar_escaneo los busque en cada lectura: p_con_aviso = false se salta
+-- esa consulta y devuelve 'aviso' nulo. Por omisión se sigue buscando, así los
+-- kioskos que aún no cargan los avisos no cambian. Se borra la firma anterior
+-- para que PostgREST no tenga dos funciones con el mismo nombre.
+drop function if exists registrar_escaneo(text, date, time, text);
+
+create or replace function registrar_escaneo(
+    p_matricula text,
+    p_fecha date,
+    p_hora time,
+    p_registro_por text,
+    p_con_aviso boolean default true
+) returns json
+language plpgsql as $$
+declare
+    v_alumno alumnos%rowtype;
+    v_aviso json;
+    v_insertadas integer;
+begin
+    select * into v_alumno from alumnos where matricula = p_matricula;
+    if not found then
+        return json_build_object('encontrado', false);
+    end if;
+
+    if v_alumno.estatus is false then
+        return json_build_object(
+            'encontrado', true,
+            'nombre', v_alumno.nombre,
+            'grupo', v_alumno.grupo,
+            'estatus', false
+        );
+    end if;
+
+    if p_con_aviso then
+        select json_build_object('mensaje', mensaje, 'prioridad', prioridad) into v_aviso
+        from avisos
+        where matricula = p_matricula and activo
+        order by id desc
+        limit 1;
+    end if;
+
+    insert into entradas (fecha, hora, matricula, nombre, grupo, registro_por)
+    values (
+        p_fecha, p_hora, p_matricula,
+        coalesce(v_alumno.nombre, 'N/A'), coalesce(v_alumno.grupo, 'N/A'),
+        coalesce(p_registro_por, 'Sistema')
+    )
+    on conflict (matricula, fecha) do nothing;
+    get diagnostics v_insertadas = row_count;
+
+    return json_build_object(
+        'encontrado', true,
+        'nombre', v_alumno.nombre,
+        'grupo', v_alumno.grupo,
+        'estatus', coalesce(v_alumno.estatus, true),
+        'aviso', v_aviso,
+        'ya_registrada', v_insertadas = 0
+    );
+end;
+$$;